@@ -0,0 +1,351 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2018 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmark.py
+
+Runs the whole installapplications.main() flow against a local HTTP origin
+and reports wall time, throughput and CPU time per scenario, so changes to
+the download and verify paths can be compared before a build goes out.
+
+Each scenario generates random payloads and a bootstrap.json for them,
+serves them from a local HTTP server with byte range support, and runs
+installapplications.py in a child process. The macOS parts are replaced in
+that child: NSLog, the console user, launchctl and the receipts database
+are stubbed and /usr/sbin/installer is a shell script that prints
+installer-style progress. Downloads use gurl's http transport, so they go
+through the same code on every platform.
+
+    python bench/benchmark.py
+    python bench/benchmark.py --scenario baseline --count 16 --size 32
+    python bench/benchmark.py --output results.json
+
+Runs on macOS and Linux. InstallApplications writes its user log to
+/private/var/tmp/installapplications, which has to be writable.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import imp
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+IA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'payload', 'Library', 'Application Support',
+                       'installapplications')
+
+MB = 1024 * 1024
+
+# name -> (description, defaults, installapplications arguments)
+SCENARIOS = [
+    ('baseline', 'Packages installed one after another',
+     {'count': 8, 'size': 8}, []),
+    ('many-small', 'Lots of small packages',
+     {'count': 64, 'size': 0.25}, []),
+    ('prefetch', 'Baseline with the next two items downloaded ahead',
+     {'count': 8, 'size': 8}, ['--prefetch-depth', '2']),
+    ('dependencies', 'Independent packages scheduled by depends_on',
+     {'count': 8, 'size': 8, 'independent': True}, ['--workers', '4']),
+    ('segmented', 'Large packages downloaded in byte ranges',
+     {'count': 2, 'size': 96}, ['--download-segments', '4']),
+]
+
+FAKE_INSTALLER = '''#!/bin/sh
+echo "installer: Package name is $3"
+echo "installer:PHASE:Preparing for installation..."
+for percent in 10 20 30 40 50 60 70 80 90 100; do
+    sleep %(step)s
+    echo "installer:%%$percent.000000"
+done
+echo "installer:PHASE:Finishing the Installation..."
+echo "installer: The install was successful."
+'''
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves files out of self.server.root with single byte range
+    support'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, body):
+        path = os.path.join(self.server.root,
+                            os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end, status = 0, size - 1, 200
+        byte_range = re.match(r'^bytes=(\d+)-(\d*)$',
+                              self.headers.get('Range', ''))
+        if byte_range:
+            start = int(byte_range.group(1))
+            if byte_range.group(2):
+                end = min(int(byte_range.group(2)), size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, size))
+        self.end_headers()
+        if not body:
+            return
+        with open(path, 'rb') as source:
+            source.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = source.read(min(2**16, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Origin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RangeHandler)
+        self.root = root
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], name)
+
+
+def makescenario(workdir, origin, count, size, independent=False):
+    '''Writes count random payloads of size MB and a bootstrap.json for them
+    to workdir. Returns the total number of bytes.'''
+    iapath = os.path.join(workdir, 'ia')
+    bootstrap = {'preflight': [], 'setupassistant': [], 'userland': []}
+    total = 0
+    for index in range(count):
+        name = 'payload%03d.pkg' % index
+        hash_function = hashlib.sha256()
+        remaining = int(size * MB)
+        with open(os.path.join(workdir, name), 'wb') as payload:
+            while remaining > 0:
+                chunk = os.urandom(min(MB, remaining))
+                hash_function.update(chunk)
+                payload.write(chunk)
+                remaining -= len(chunk)
+        total += int(size * MB)
+        # Alternate stages like a real bootstrap.json would.
+        stage = 'setupassistant' if index % 2 == 0 else 'userland'
+        item = {'file': os.path.join(iapath, name), 'url': origin.url(name),
+                'hash': hash_function.hexdigest(), 'name': name,
+                'type': 'package', 'packageid': 'com.example.bench.%d' % index,
+                'version': '1.0'}
+        if independent:
+            item['depends_on'] = []
+        bootstrap[stage].append(item)
+    with open(os.path.join(workdir, 'bootstrap.json'), 'w') as f:
+        json.dump(bootstrap, f)
+    return total
+
+
+def installstubs(logpath):
+    '''Replaces the macOS modules installapplications.py imports'''
+    log = open(logpath, 'a')
+
+    def nslog(format, *args):
+        if format == '%@':
+            format, args = args[0], ()
+        log.write((format % args if args else format) + '\n')
+
+    class NSDictionary(object):
+        @staticmethod
+        def dictionaryWithContentsOfFile_(path):
+            import plistlib
+            try:
+                return plistlib.readPlist(path)
+            except Exception:
+                return None
+
+    modules = {
+        'Foundation': {'NSLog': nslog, 'NSDictionary': NSDictionary},
+        'SystemConfiguration': {
+            'SCDynamicStoreCopyConsoleUser':
+                lambda *args: (u'bench', os.getuid(), os.getgid())},
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+def runchild(args):
+    '''Runs installapplications.main() for one scenario. This is the child
+    process, so the stubs don't leak into the parent.'''
+    installstubs(os.path.join(args.workdir, 'installapplications.log'))
+    sys.path.insert(0, IA_PATH)
+    ia = imp.load_source('installapplications',
+                         os.path.join(IA_PATH, 'installapplications.py'))
+    installer = os.path.join(args.workdir, 'installer')
+    with open(installer, 'w') as f:
+        f.write(FAKE_INSTALLER % {'step': args.install_seconds / 10.0})
+    os.chmod(installer, 0755)
+    ia.INSTALLER = installer
+    ia.RECEIPTS_PATH = os.path.join(args.workdir, 'receipts')
+    os.makedirs(ia.RECEIPTS_PATH)
+    ia.launchctl = lambda *arg: ''
+    # main() insists on running as root.
+    os.getuid = lambda: 0
+    sys.argv = ['installapplications.py',
+                '--jsonurl', args.jsonurl,
+                '--iapath', os.path.join(args.workdir, 'ia'),
+                '--ldidentifier', 'com.example.installapplications.bench',
+                '--laidentifier', 'com.example.installapplications.bench',
+                '--report-path', os.path.join(args.workdir, 'report.json'),
+                '--transport', 'http',
+                ] + args.iaargs
+    try:
+        ia.main()
+    except SystemExit as err:
+        return err.code or 0
+    return 0
+
+
+def runscenario(name, options, iaargs, install_seconds, keep):
+    '''Runs one scenario and returns its measurements'''
+    workdir = tempfile.mkdtemp(prefix='iabench-')
+    origin = Origin(workdir)
+    try:
+        total = makescenario(workdir, origin, options['count'],
+                             options['size'], options.get('independent'))
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        returncode = subprocess.call(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             '--workdir', workdir,
+             '--jsonurl', origin.url('bootstrap.json'),
+             '--install-seconds', str(install_seconds), '--'] + iaargs)
+        wall = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report = None
+        if os.path.isfile(os.path.join(workdir, 'report.json')):
+            with open(os.path.join(workdir, 'report.json')) as f:
+                report = json.load(f)
+        download = sum(item.get('download_seconds', 0)
+                       for item in (report or {}).get('items', []))
+        return {'scenario': name, 'returncode': returncode,
+                'count': options['count'], 'size_mb': options['size'],
+                'bytes': total, 'wall_seconds': wall,
+                'bytes_per_second': total / wall,
+                'download_seconds': download,
+                'cpu_user_seconds': after.ru_utime - before.ru_utime,
+                'cpu_system_seconds': after.ru_stime - before.ru_stime,
+                'workdir': workdir if keep else None}
+    finally:
+        origin.shutdown()
+        origin.server_close()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark installapplications.py end to end.')
+    parser.add_argument('--scenario', action='append', default=[],
+                        choices=[x[0] for x in SCENARIOS],
+                        help='Scenario to run. Can be passed multiple times. '
+                             'Defaults to all of them.')
+    parser.add_argument('--count', type=int,
+                        help='Number of packages, overriding the scenario.')
+    parser.add_argument('--size', type=float,
+                        help='Size of each package in MB, overriding the '
+                             'scenario.')
+    parser.add_argument('--install-seconds', type=float, default=0.5,
+                        help='How long the fake installer takes per '
+                             'package.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each scenario this many times.')
+    parser.add_argument('--output', help='Write the results as JSON here.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the scenario directories and logs.')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--jsonurl', help=argparse.SUPPRESS)
+    parser.add_argument('iaargs', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.exit(runchild(args))
+
+    if not os.path.isdir('/private/var/tmp/installapplications'):
+        try:
+            os.makedirs('/private/var/tmp/installapplications')
+        except OSError as err:
+            print >> sys.stderr, (
+                '/private/var/tmp/installapplications has to exist and be '
+                'writable: %s' % err)
+            sys.exit(1)
+
+    results = []
+    print '%-14s %5s %8s %9s %9s %9s %9s' % (
+        'scenario', 'count', 'MB', 'wall s', 'MB/s', 'user s', 'sys s')
+    for name, description, defaults, iaargs in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        options = dict(defaults)
+        if args.count is not None:
+            options['count'] = args.count
+        if args.size is not None:
+            options['size'] = args.size
+        for x in range(args.repeat):
+            result = runscenario(name, options, iaargs, args.install_seconds,
+                                 args.keep)
+            results.append(result)
+            print '%-14s %5d %8.1f %9.2f %9.1f %9.2f %9.2f%s' % (
+                name, result['count'], float(result['bytes']) / MB,
+                result['wall_seconds'], result['bytes_per_second'] / MB,
+                result['cpu_user_seconds'], result['cpu_system_seconds'],
+                '' if result['returncode'] == 0 else
+                '  (exit %s)' % result['returncode'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
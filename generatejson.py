@@ -10,19 +10,54 @@
 # item-url='A url' \
 # script-do-not-wait='A boolean' \
 # --base-url URL \
+# --output PATH \
+# --jobs N \
+# --cache-file PATH \
+# --chunk-size MB
+#
+# or: python generatejson.py --scan-dir DIR --base-url URL --output PATH
+# or: python generatejson.py --batch items.json|items.csv --base-url URL \
 # --output PATH
 
 #
 # --item can be used unlimited times
 # Future plan for this tool is to add AWS S3 integration for auto-upload
 
+import bz2
+import collections
+import csv
 import hashlib
 import json
 import argparse
 import os
-import subprocess
-import tempfile
+import struct
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+# The keys of an item, as passed to --item or listed in a batch file
+ITEM_KEYS = ('item-name', 'item-path', 'item-stage', 'item-type', 'item-url',
+             'script-do-not-wait')
+STAGES = ('preflight', 'setupassistant', 'userland')
+SCRIPT_EXTENSIONS = ('.py', '.sh', '.rb', '.php')
+
+# What we learned about files on earlier runs, loaded from --cache-file and
+# keyed by absolute path, and what we learned about the files of this run,
+# which is saved back to it. Each entry holds the size, mtime and inode the
+# file had, its sha256, for packages its packageid and version, and with
+# --chunk-size the chunk size and chunk digests. Bump the version whenever
+# what we record or how we read files changes, so older caches are dropped.
+METADATA_CACHE_VERSION = 2
+g_metadata_cache = {}
+g_metadata_seen = {}
+g_metadata_lock = threading.Lock()
+
+# Packages are xar archives. The header is followed by the zlib compressed
+# table of contents and then the heap that holds the files.
+XAR_MAGIC = 'xar!'
+XAR_HEADER = struct.Struct('>4sHHQQI')
 
 
 def gethash(filename):
@@ -40,45 +75,119 @@ def gethash(filename):
     return hash_function.hexdigest()
 
 
-def getpkginfopath(filename):
-    '''Extracts the package BOM with xar'''
-    cmd = ['/usr/bin/xar', '-tf', filename]
-    proc = subprocess.Popen(cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (bom, err) = proc.communicate()
-    bom = bom.strip().split('\n')
-    if proc.returncode == 0:
-        for entry in bom:
-            if entry.startswith('PackageInfo'):
-                return entry
-            elif entry.endswith('.pkg/PackageInfo'):
-                return entry
-    else:
-        print "Error: %s while extracting BOM for %s" % (err, filename)
+def getchunkhashes(filename, chunkSize):
+    '''Returns the sha256 digest of filename and a list of the sha256 digests
+    of each chunkSize bytes of it, reading it once'''
+    hash_function = hashlib.sha256()
+    chunkHashes = []
+    with open(filename, 'rb') as fileref:
+        while 1:
+            chunk_function = hashlib.sha256()
+            remaining = chunkSize
+            while remaining:
+                chunk = fileref.read(min(2**16, remaining))
+                if not chunk:
+                    break
+                hash_function.update(chunk)
+                chunk_function.update(chunk)
+                remaining -= len(chunk)
+            if remaining == chunkSize:
+                break
+            chunkHashes.append(chunk_function.hexdigest())
+            if remaining:
+                break
+    return hash_function.hexdigest(), chunkHashes
+
+
+def readxartoc(fileref):
+    '''Takes an open xar archive and returns its table of contents as a
+    minidom document, and the offset of the heap the files are stored in.'''
+    header = fileref.read(XAR_HEADER.size)
+    if len(header) < XAR_HEADER.size:
+        raise ValueError('not a xar archive')
+    (magic, headerSize, version, tocLength, tocSize,
+     checksumAlgorithm) = XAR_HEADER.unpack(header)
+    if magic != XAR_MAGIC:
+        raise ValueError('not a xar archive')
+    # the header can be longer than the fields we know about
+    fileref.seek(headerSize)
+    toc = zlib.decompress(fileref.read(tocLength))
+    return minidom.parseString(toc), headerSize + tocLength
+
+
+def childelement(element, tagName):
+    '''Returns the first child element of element named tagName'''
+    for node in element.childNodes:
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == tagName:
+            return node
+
+
+def childtext(element, tagName):
+    '''Returns the text of the first child element of element named
+    tagName'''
+    node = childelement(element, tagName)
+    if node is None:
+        return ''
+    return ''.join(text.data for text in node.childNodes
+                   if text.nodeType == text.TEXT_NODE).strip()
+
+
+def xarentries(element, parent=''):
+    '''Yields the path and file element of every file in a xar table of
+    contents, in the order xar -t lists them'''
+    for node in element.childNodes:
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'file':
+            path = parent + childtext(node, 'name')
+            yield path, node
+            for entry in xarentries(node, path + '/'):
+                yield entry
+
+
+def readxarentry(fileref, heapOffset, entry):
+    '''Returns the contents of a file element from a xar table of
+    contents, reading just its part of the heap'''
+    data = childelement(entry, 'data')
+    if data is None:
+        return ''
+    offset = int(childtext(data, 'offset'))
+    length = int(childtext(data, 'length'))
+    encoding = childelement(data, 'encoding')
+    style = encoding.getAttribute('style') if encoding is not None else ''
+    fileref.seek(heapOffset + offset)
+    archived = fileref.read(length)
+    if style == 'application/x-gzip':
+        # xar calls it gzip, but it is a zlib stream
+        return zlib.decompress(archived)
+    if style == 'application/x-bzip2':
+        return bz2.decompress(archived)
+    if style in ('', 'application/octet-stream'):
+        return archived
+    raise ValueError('unsupported xar encoding %s' % style)
+
+
+def getpkginfopath(toc):
+    '''Returns the path and file element of the PackageInfo file in the
+    package's xar table of contents'''
+    files = childelement(toc.documentElement, 'toc')
+    if files is None:
+        return None, None
+    for path, entry in xarentries(files):
+        if path.startswith('PackageInfo'):
+            return path, entry
+        elif path.endswith('.pkg/PackageInfo'):
+            return path, entry
+    return None, None
 
 
 def extractpkginfo(filename):
-    '''Takes input of a file path and returns a file path to the
-    extracted PackageInfo file.'''
-    cwd = os.getcwd()
-
-    if not os.path.isfile(filename):
-        return
-    else:
-        tmpFolder = tempfile.mkdtemp()
-        os.chdir(tmpFolder)
-        # need to get path from BOM
-        pkgInfoPath = getpkginfopath(filename)
-
-        extractedPkgInfoPath = os.path.join(tmpFolder, pkgInfoPath)
-        cmd = ['/usr/bin/xar', '-xf', filename, pkgInfoPath]
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        out, err = proc.communicate()
-        os.chdir(cwd)
-        return extractedPkgInfoPath
+    '''Takes input of a file path and returns the contents of the
+    package's PackageInfo file, read straight out of the xar archive.'''
+    with open(filename, 'rb') as fileref:
+        toc, heapOffset = readxartoc(fileref)
+        pkgInfoPath, entry = getpkginfopath(toc)
+        if entry is None:
+            raise ValueError('no PackageInfo')
+        return readxarentry(fileref, heapOffset, entry)
 
 
 def getpkginfo(filename):
@@ -88,13 +197,272 @@ def getpkginfo(filename):
         return "", ""
 
     else:
-        pkgInfoPath = extractpkginfo(filename)
-        dom = minidom.parse(pkgInfoPath)
+        try:
+            dom = minidom.parseString(extractpkginfo(filename))
+        except (IOError, ValueError, zlib.error, ExpatError) as err:
+            print "Error: %s while reading PackageInfo from %s" % (
+                err, filename)
+            return "", ""
         pkgRefs = dom.getElementsByTagName('pkg-info')
         for ref in pkgRefs:
             pkgId = ref.attributes['identifier'].value.encode('UTF-8')
             pkgVersion = ref.attributes['version'].value.encode('UTF-8')
             return pkgId, pkgVersion
+        return "", ""
+
+
+def fileidentity(filename):
+    '''Returns the size, mtime and inode of filename, which tell us whether it
+    changed since we last looked at it'''
+    st = os.stat(filename)
+    return {'size': st.st_size,
+            'mtime': getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+            'inode': st.st_ino}
+
+
+def loadmetadatacache(cachePath):
+    '''Loads g_metadata_cache from cachePath. A missing or unreadable cache
+    just means every file is inspected again.'''
+    global g_metadata_cache
+    try:
+        with open(cachePath) as cacheFile:
+            cache = json.load(cacheFile)
+    except (IOError, ValueError):
+        return
+    if (isinstance(cache, dict) and
+            cache.get('version') == METADATA_CACHE_VERSION):
+        g_metadata_cache = cache.get('files', {})
+
+
+def savemetadatacache(cachePath):
+    '''Saves the entries for the files of this run to cachePath, dropping
+    the files we didn't see'''
+    cache = {'version': METADATA_CACHE_VERSION, 'files': g_metadata_seen}
+    try:
+        with open(cachePath + '.tmp', 'w') as cacheFile:
+            json.dump(cache, cacheFile, sort_keys=True, indent=2)
+        os.rename(cachePath + '.tmp', cachePath)
+    except (IOError, OSError) as err:
+        print '[Error] Could not save cache file %s: %s' % (cachePath, err)
+
+
+def inspectitem(item):
+    '''Takes a (file path, item type, chunk size) tuple and returns the
+    file's hash, for packages a (package identifier, version) tuple, and the
+    digests of its chunks if it is bigger than one chunk. Files that haven't
+    changed since the last run come from g_metadata_cache.'''
+    filePath, itemType, chunkSize = item
+    if not os.path.isfile(filePath):
+        fileHash = gethash(filePath)
+        if itemType == 'package':
+            return fileHash, getpkginfo(filePath), None
+        return fileHash, None, None
+
+    cacheKey = os.path.abspath(filePath)
+    identity = fileidentity(filePath)
+    with g_metadata_lock:
+        entry = g_metadata_seen.get(cacheKey) or g_metadata_cache.get(
+            cacheKey)
+    wantChunks = chunkSize and identity['size'] > chunkSize
+    if (entry is None
+            or any(entry.get(key) != value
+                   for key, value in identity.items())
+            or (wantChunks and entry.get('chunk_size') != chunkSize)):
+        entry = dict(identity)
+        if wantChunks:
+            entry['sha256'], entry['chunk_hashes'] = getchunkhashes(
+                filePath, chunkSize)
+            entry['chunk_size'] = chunkSize
+        else:
+            entry['sha256'] = gethash(filePath)
+    else:
+        entry = dict(entry)
+    pkgInfo = None
+    if itemType == 'package':
+        if entry.get('packageid'):
+            pkgInfo = (entry['packageid'].encode('UTF-8'),
+                       entry['version'].encode('UTF-8'))
+        else:
+            pkgInfo = getpkginfo(filePath)
+            # A failed read isn't remembered, so it is retried on every run.
+            if pkgInfo[0]:
+                # stored as unicode, like they are when loaded from the cache
+                entry['packageid'] = pkgInfo[0].decode('UTF-8')
+                entry['version'] = pkgInfo[1].decode('UTF-8')
+    with g_metadata_lock:
+        g_metadata_seen[cacheKey] = entry
+
+    chunkHashes = entry.get('chunk_hashes') if wantChunks else None
+    return entry['sha256'], pkgInfo, chunkHashes
+
+
+def mapjobs(function, items, jobs):
+    '''Yields function(item) for each of items, in order, working on up to
+    jobs items at once. items is read on this thread and only a few items
+    ahead of the results, so it can be a generator.'''
+    if jobs <= 1:
+        for item in items:
+            yield function(item)
+        return
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parseitemargs(itemArgs):
+    '''Takes the key=value arguments of an --item and returns them as a
+    dict. Values can contain =, as URLs with a query string do.'''
+    processedItem = {}
+    for itemOption in itemArgs:
+        key, value = itemOption.split('=', 1)
+        processedItem[key] = value
+    return processedItem
+
+
+def defaultitem(item):
+    '''Takes an item from a batch file or a directory scan and returns it
+    with the keys it leaves out blank, so they get the usual defaults.
+    script-do-not-wait defaults to False.'''
+    processedItem = dict.fromkeys(ITEM_KEYS, '')
+    processedItem['script-do-not-wait'] = 'False'
+    for key, value in item.items():
+        if value is None:
+            value = ''
+        elif not isinstance(value, basestring):
+            value = str(value)
+        processedItem[key] = value
+    return processedItem
+
+
+def readbatch(batchPath):
+    '''Yields the items of a batch file: a JSON list of objects, or a CSV
+    file with a header row, using the --item keys'''
+    with open(batchPath, 'rb') as batchFile:
+        if os.path.splitext(batchPath)[1].lower() == '.csv':
+            for row in csv.DictReader(batchFile):
+                yield defaultitem(row)
+        else:
+            for item in json.load(batchFile):
+                yield defaultitem(item)
+
+
+def scanfiles(folder):
+    '''Returns the packages and scripts in folder, sorted by name'''
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, fileName)
+            for fileName in sorted(os.listdir(folder))
+            if not fileName.startswith('.') and
+            os.path.isfile(os.path.join(folder, fileName)) and
+            os.path.splitext(fileName)[1] in SCRIPT_EXTENSIONS + ('.pkg',)]
+
+
+def scandirectory(rootDir, baseUrl):
+    '''Yields an item for every package and script in the preflight,
+    setupassistant and userland folders of rootDir. Scripts in a
+    userscripts folder inside a stage folder are userscripts.'''
+    for stage in STAGES:
+        stageDir = os.path.join(rootDir, stage)
+        for filePath in scanfiles(stageDir):
+            yield defaultitem({'item-path': filePath, 'item-stage': stage})
+        for filePath in scanfiles(os.path.join(stageDir, 'userscripts')):
+            if filePath.endswith('.pkg'):
+                continue
+            yield defaultitem({
+                'item-path': filePath, 'item-stage': stage,
+                'item-type': 'userscript',
+                'item-url': '%s/%s/userscripts/%s' % (
+                    baseUrl, stage, os.path.basename(filePath))})
+
+
+def processitem(item, baseUrl):
+    '''Takes the key value pairs of an item, validates them and fills in the
+    defaults. Returns the item's json without its hash, its stage, the path
+    of its file and its type.'''
+    itemJson = {}
+    # Get the file extension of the file
+    fileExt = os.path.splitext(item['item-path'])[1]
+    # Get the file name of the file
+    fileName = os.path.basename(item['item-path'])
+    # Get the full path of the file
+    filePath = item['item-path']
+
+    # Determine the type of item to process - for scripts, default to
+    # rootscript
+    if fileExt in ('.py', '.sh', '.rb', '.php'):
+        if item['item-type']:
+            itemJson['type'] = itemType = item['item-type']
+        else:
+            itemJson['type'] = itemType = 'rootscript'
+    elif fileExt == '.pkg':
+        itemJson['type'] = itemType = 'package'
+    else:
+        print 'Could not determine package type for item or unsupported: \
+        %s' % str(item)
+        exit(1)
+    if itemType not in ('package', 'rootscript', 'userscript'):
+        print 'item-type malformed: %s' % str(item['item-type'])
+        exit(1)
+
+    # Determine the stage of the item to process - default to userland
+    if item['item-stage']:
+        if item['item-stage'] in ('preflight', 'setupassistant',
+                                  'userland'):
+            itemStage = item['item-stage']
+            pass
+        else:
+            print 'item-stage malformed: %s' % str(item['item-stage'])
+            exit(1)
+    else:
+        itemStage = 'userland'
+
+    # Determine the url of the item to process - defaults to
+    # baseurl/stage/filename
+    if not item['item-url']:
+        itemJson['url'] = '%s/%s/%s' % (baseUrl, itemStage, fileName)
+    else:
+        itemJson['url'] = item['item-url']
+
+    # Determine the name of the item to process - defaults to the filename
+    if not item['item-name']:
+        itemJson['name'] = fileName
+    else:
+        itemJson['name'] = item['item-name']
+
+    # Add information for scripts and packages
+    if itemType in ('rootscript', 'userscript'):
+        if itemType == 'userscript':
+            # Pass the userscripts folder path
+            itemJson['file'] = '/Library/Application Support/'\
+                'installapplications/userscripts/%s' % fileName
+        else:
+            itemJson['file'] = '/Library/Application Support/'\
+                'installapplications/%s' % fileName
+        # Check crappy way of doing booleans
+        if item['script-do-not-wait'] in ('true', 'True', '1',
+                                          'false', 'False', '0'):
+            # If True, pass the key to the item
+            if item['script-do-not-wait'] in ('true', 'True', '1'):
+                itemJson['donotwait'] = True
+        else:
+            print 'script-do-not-wait malformed: %s ' % str(
+                item['script-do-not-wait'])
+            exit(1)
+    # If packages, we need the version and packageid
+    elif itemType == 'package':
+        itemJson['file'] = '/Library/Application Support/'\
+            'installapplications/%s' % fileName
+
+    return itemJson, itemStage, filePath, itemType
 
 
 def main():
@@ -110,22 +478,52 @@ def main():
                         help='Required: Options for item. All items are \
                         required. Scripts default to rootscript and stage \
                         defaults to userland')
+    parser.add_argument('--batch', default=None, action='append',
+                        help='Optional: JSON or CSV file listing items, with \
+                        the --item keys. Can be used more than once')
+    parser.add_argument('--scan-dir', default=None, action='append',
+                        help='Optional: Add every package and script in the \
+                        preflight, setupassistant and userland folders of \
+                        this directory. Can be used more than once')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Optional: Number of files to hash and inspect \
+                        at once. Defaults to 1.')
+    parser.add_argument('--cache-file', default=None, action='store',
+                        help='Optional: File to remember the hash, packageid \
+                        and version of each file in, so files that have not \
+                        changed are not read again on the next run')
+    parser.add_argument('--chunk-size', default=0, type=int,
+                        help='Optional: Also list the SHA256 of every chunk \
+                        of this many megabytes of files bigger than one \
+                        chunk, so a corrupt download only has to fetch the \
+                        bad chunks again')
     args = parser.parse_args()
 
     # Bail if we don't have one item, the base url and the output dir
-    if not args.item or not args.base_url or not args.output:
+    if (not (args.item or args.batch or args.scan_dir) or not args.base_url
+            or not args.output):
         parser.print_help()
         exit(1)
 
     # Let's first loop through the items and convert everything to key value
-    # pairs
-    itemsToProcess = []
-    for item in args.item:
-        processedItem = {}
-        for itemOption in item:
-            values = itemOption.split('=')
-            processedItem[values[0]] = values[1]
-        itemsToProcess.append(processedItem)
+    # pairs: the --item arguments, then the batch files, then the scanned
+    # directories. Batch files and directories are read as we go.
+    def itemsfromargs():
+        for item in args.item or []:
+            yield parseitemargs(item)
+        for batchPath in args.batch or []:
+            try:
+                for item in readbatch(batchPath):
+                    yield item
+            except (IOError, ValueError, TypeError, AttributeError,
+                    csv.Error) as err:
+                print '[Error] Could not read batch file %s: %s' % (
+                    batchPath, err)
+                exit(1)
+        for rootDir in args.scan_dir or []:
+            for item in scandirectory(rootDir, args.base_url):
+                yield item
+    itemsToProcess = itemsfromargs()
 
     # Create our stages now so InstallApplications won't blow up
     stages = {
@@ -134,90 +532,44 @@ def main():
         'userland': []
     }
 
-    # Process each item in the order they were passed in
-    for item in itemsToProcess:
-        itemJson = {}
-        # Get the file extension of the file
-        fileExt = os.path.splitext(item['item-path'])[1]
-        # Get the file name of the file
-        fileName = os.path.basename(item['item-path'])
-        # Get the full path of the file
-        filePath = item['item-path']
-
-        # Determine the type of item to process - for scripts, default to
-        # rootscript
-        if fileExt in ('.py', '.sh', '.rb', '.php'):
-            if item['item-type']:
-                itemJson['type'] = itemType = item['item-type']
-            else:
-                itemJson['type'] = itemType = 'rootscript'
-        elif fileExt == '.pkg':
-            itemJson['type'] = itemType = 'package'
-        else:
-            print 'Could not determine package type for item or unsupported: \
-            %s' % str(item)
-            exit(1)
-        if itemType not in ('package', 'rootscript', 'userscript'):
-            print 'item-type malformed: %s' % str(item['item-type'])
-            exit(1)
-
-        # Determine the stage of the item to process - default to userland
-        if item['item-stage']:
-            if item['item-stage'] in ('preflight', 'setupassistant',
-                                      'userland'):
-                itemStage = item['item-stage']
-                pass
-            else:
-                print 'item-stage malformed: %s' % str(item['item-stage'])
-                exit(1)
-        else:
-            itemStage = 'userland'
-
-        # Determine the url of the item to process - defaults to
-        # baseurl/stage/filename
-        if not item['item-url']:
-            itemJson['url'] = '%s/%s/%s' % (args.base_url, itemStage, fileName)
-        else:
-            itemJson['url'] = item['item-url']
-
-        # Determine the name of the item to process - defaults to the filename
-        if not item['item-name']:
-            itemJson['name'] = fileName
-        else:
-            itemJson['name'] = item['item-name']
-
-        # Determine the hash of the item to process - SHA256
-        itemJson['hash'] = gethash(filePath)
-
-        # Add information for scripts and packages
-        if itemType in ('rootscript', 'userscript'):
-            if itemType == 'userscript':
-                # Pass the userscripts folder path
-                itemJson['file'] = '/Library/Application Support/'\
-                    'installapplications/userscripts/%s' % fileName
-            else:
-                itemJson['file'] = '/Library/Application Support/'\
-                    'installapplications/%s' % fileName
-            # Check crappy way of doing booleans
-            if item['script-do-not-wait'] in ('true', 'True', '1',
-                                              'false', 'False', '0'):
-                # If True, pass the key to the item
-                if item['script-do-not-wait'] in ('true', 'True', '1'):
-                    itemJson['donotwait'] = True
-            else:
-                print 'script-do-not-wait malformed: %s ' % str(
-                    item['script-do-not-wait'])
-                exit(1)
-        # If packages, we need the version and packageid
-        elif itemType == 'package':
-            (pkgId, pkgVersion) = getpkginfo(filePath)
-            itemJson['file'] = '/Library/Application Support/'\
-                'installapplications/%s' % fileName
+    # Process each item in the order they were passed in, hashing and
+    # inspecting files --jobs at a time as the items are read.
+    processedItems = (processitem(item, args.base_url)
+                      for item in itemsToProcess)
+
+    # Determine the hash of each item - SHA256 - and the version and
+    # packageid of packages
+    if args.cache_file:
+        loadmetadatacache(args.cache_file)
+    chunkSize = args.chunk_size * 1024 * 1024
+
+    def inspect(processedItem):
+        itemJson, itemStage, filePath, itemType = processedItem
+        return processedItem, inspectitem((filePath, itemType, chunkSize))
+
+    failed = False
+    for (itemJson, itemStage, filePath, itemType), \
+            (fileHash, pkgInfo, chunkHashes) in mapjobs(
+                inspect, processedItems, args.jobs):
+        itemJson['hash'] = fileHash
+        if chunkHashes:
+            itemJson['chunk_size'] = chunkSize
+            itemJson['chunk_hashes'] = chunkHashes
+        if itemType == 'package':
+            (pkgId, pkgVersion) = pkgInfo
+            if not pkgId:
+                print '[Error] Could not read the packageid and version ' \
+                    'of %s' % filePath
+                failed = True
             itemJson['packageid'] = pkgId
             itemJson['version'] = pkgVersion
 
         # Append the info to the appropriate stage
         stages[itemStage].append(itemJson)
+    if args.cache_file:
+        savemetadatacache(args.cache_file)
+    if failed:
+        exit(1)
 
     # Saving the json file to the output directory path
     if args.output:
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2018 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+agentipc.py
+
+Hands user scripts from the LaunchDaemon to the LaunchAgent over a Unix
+domain socket. The daemon listens with an AgentServer; the LaunchAgent
+connects with serve() and stays running until it is told to quit, so every
+user script after the first one starts without launchd starting a new agent.
+
+Messages are JSON objects, one per line:
+
+    daemon -> agent    {"command": "run", "path": "/path/to/script"}
+    agent -> daemon    {"path": "/path/to/script", "returncode": 0,
+                        "output": "..."}
+    daemon -> agent    {"command": "quit"}
+"""
+
+import errno
+import json
+import os
+import select
+import socket
+import stat
+
+
+def makesocketdir(path):
+    '''Creates the directory the socket lives in if it doesn't exist yet.
+    Raises OSError unless it is a real directory that only we can write to,
+    as otherwise someone could swap the socket for a link to another file
+    before we chown it.'''
+    try:
+        os.mkdir(path, 0755)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise OSError(errno.EPERM, 'Not a private directory', path)
+
+
+class AgentServer(object):
+    '''The daemon's end of the socket. Only one agent is talked to at a
+    time, and only the user with uid can connect.'''
+
+    def __init__(self, path, uid):
+        self.path = path
+        self.uid = uid
+        makesocketdir(os.path.dirname(path))
+        if os.path.lexists(path):
+            os.remove(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.listener.bind(path)
+            # The agent runs as the logged in user. Nobody else may hand us
+            # results or see which scripts we run. Nobody can connect before
+            # we listen.
+            os.lchown(path, uid, -1)
+            os.chmod(path, 0700)
+            st = os.lstat(path)
+            if not stat.S_ISSOCK(st.st_mode) or st.st_uid != uid:
+                raise OSError(errno.EPERM, 'Socket was replaced', path)
+        except (socket.error, OSError):
+            self.listener.close()
+            raise
+        self.listener.listen(1)
+        self.connection = None
+        self.reader = None
+
+    def accept(self, timeout):
+        '''Waits up to timeout seconds for the agent to connect. Returns True
+        if an agent is connected.'''
+        if self.connection is None:
+            readable, _, _ = select.select([self.listener], [], [], timeout)
+            if readable:
+                self.connection, _ = self.listener.accept()
+                self.reader = self.connection.makefile('rb')
+        return self.connection is not None
+
+    def send(self, message):
+        self.connection.sendall(json.dumps(message) + '\n')
+
+    def run(self, path):
+        '''Has the agent run the script at path. Returns (returncode, output),
+        or None if the agent went away first.'''
+        try:
+            self.send({'command': 'run', 'path': path})
+            line = self.reader.readline()
+        except socket.error:
+            line = ''
+        if not line:
+            self.disconnect()
+            return None
+        try:
+            reply = json.loads(line)
+        except ValueError:
+            self.disconnect()
+            return None
+        return reply.get('returncode'), reply.get('output', '')
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.reader.close()
+            self.connection.close()
+        self.connection = None
+        self.reader = None
+
+    def close(self):
+        '''Tells the agent to quit and stops listening'''
+        if self.connection is not None:
+            try:
+                self.send({'command': 'quit'})
+            except socket.error:
+                pass
+            self.disconnect()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def serve(path, runscript, timeout=5):
+    '''The agent's end of the socket. Connects to the daemon at path and runs
+    each script it is sent with runscript, which returns (returncode,
+    output), until the daemon says quit or goes away. Returns False if the
+    daemon isn't listening.'''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return False
+    connection.settimeout(None)
+    reader = connection.makefile('rb')
+    try:
+        for line in iter(reader.readline, ''):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get('command') == 'quit':
+                break
+            if message.get('command') == 'run':
+                returncode, output = runscript(message['path'])
+                connection.sendall(json.dumps({
+                    'path': message['path'], 'returncode': returncode,
+                    'output': output}) + '\n')
+    except socket.error:
+        pass
+    finally:
+        reader.close()
+        connection.close()
+    return True
@@ -0,0 +1,396 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2018 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+cacheproxy.py
+
+A small caching HTTP proxy for site-local enrollment bursts. Point
+InstallApplications at it with --cache-proxy (or "cache_proxy" in
+bootstrap.json) and every item is requested as
+
+    GET /?url=<origin url>&hash=<sha256>
+
+The first request for an object fetches it from the origin, verifies its hash
+and stores it. Concurrent requests for the same object wait for that single
+upstream fetch instead of starting their own. Cached objects are served with
+Range support so gurl can resume and segment downloads. Requests without a
+hash, and HEAD requests for objects that aren't cached yet, are passed
+through to the origin without storing anything.
+
+Only URLs under an origin passed with --allow-origin are fetched, so the
+proxy can't be used as an open relay. Runs standalone and only needs the
+Python standard library:
+
+    python cacheproxy.py --port 8080 --cache-dir /var/tmp/iacache \
+        --allow-origin https://domain.tld/
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import optparse
+import os
+import posixpath
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+from email.utils import formatdate
+from urllib import unquote
+from urlparse import parse_qs, urlparse
+
+# Headers of an origin response that are passed on to the client when a
+# request is passed through.
+RELAYED_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range',
+                   'Accept-Ranges', 'ETag', 'Last-Modified')
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class OriginRedirectHandler(urllib2.HTTPRedirectHandler):
+    '''Follows redirects only to URLs the cache is allowed to fetch, and
+    keeps HEAD requests HEAD requests'''
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not self.cache.allowed(newurl):
+            raise urllib2.URLError('Redirect to disallowed url %s' % newurl)
+        request = urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+        if request is not None and req.get_method() == 'HEAD':
+            request = HeadRequest(
+                request.get_full_url(), headers=request.headers,
+                origin_req_host=request.get_origin_req_host(),
+                unverifiable=True)
+        return request
+
+
+class ObjectCache(object):
+    '''Objects fetched from the origin, stored by hash, with concurrent misses
+    for the same object coalesced into a single upstream fetch'''
+
+    def __init__(self, cachedir, maxbytes, allowed_origins, timeout=60):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.allowed_origins = allowed_origins
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.opener = urllib2.build_opener(OriginRedirectHandler(self))
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def path(self, hash):
+        return os.path.join(self.cachedir, hash[:2], hash)
+
+    def allowed(self, url):
+        '''Returns True if url is on one of self.allowed_origins'''
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            return False
+        # Compare the path the origin will resolve, so a prefix can't be
+        # escaped with ../
+        path = posixpath.normpath(unquote(parsed.path) or '/')
+        for origin in self.allowed_origins:
+            allowed = urlparse(origin)
+            prefix = allowed.path.rstrip('/')
+            if (parsed.scheme == allowed.scheme
+                    and parsed.netloc.lower() == allowed.netloc.lower()
+                    and (path == prefix or path.startswith(prefix + '/'))):
+                return True
+        return False
+
+    def open(self, request):
+        '''Sends request to the origin and returns the response'''
+        return self.opener.open(request, timeout=self.timeout)
+
+    def get(self, url, hash, headers=None):
+        '''Returns the cached object with this sha256 open for reading,
+        fetching it from the origin first if needed. Raises IOError if the
+        object can't be fetched.'''
+        hash = hash.lower()
+        path = self.path(hash)
+        while True:
+            with self.lock:
+                if os.path.isfile(path):
+                    # Mark it as recently used. Only the access time
+                    # changes, as the modification time is the
+                    # Last-Modified we serve and has to stay put for
+                    # clients to resume.
+                    os.utime(path, (time.time(), os.stat(path).st_mtime))
+                    # An open file can still be read if it is evicted.
+                    return open(path, 'rb')
+                event = self.inflight.get(hash)
+                if event is None:
+                    event = threading.Event()
+                    self.inflight[hash] = event
+                    break
+            # Someone else is already fetching it. Wait for them and look
+            # again.
+            event.wait()
+        try:
+            source = self.fetch(url, hash, headers or {}, path)
+        finally:
+            with self.lock:
+                del self.inflight[hash]
+            event.set()
+        self.prune(keep=path)
+        return source
+
+    def fetch(self, url, hash, headers, path):
+        '''Downloads url to path, verifying its sha256, and returns it open
+        for reading'''
+        log('Fetching %s' % url)
+        response = self.open(urllib2.Request(url, headers=headers))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+        hash_function = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                while 1:
+                    chunk = response.read(2**16)
+                    if not chunk:
+                        break
+                    hash_function.update(chunk)
+                    destination.write(chunk)
+            if hash_function.hexdigest() != hash:
+                raise IOError('Hash mismatch for %s - received: %s '
+                              'expected: %s' % (
+                                  url, hash_function.hexdigest(), hash))
+            with self.lock:
+                os.rename(tmppath, path)
+                return open(path, 'rb')
+        finally:
+            if os.path.isfile(tmppath):
+                os.remove(tmppath)
+
+    def prune(self, keep=None):
+        '''Removes the least recently used objects, by access time, until the
+        cache holds no more than self.maxbytes. The object at keep, which was just fetched,
+        is never removed, even if it is larger than self.maxbytes.'''
+        with self.lock:
+            entries = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(self.cachedir):
+                for filename in filenames:
+                    entry = os.path.join(dirpath, filename)
+                    if filename.startswith('tmp'):
+                        # an upstream fetch in progress
+                        continue
+                    st = os.stat(entry)
+                    total += st.st_size
+                    if entry != keep:
+                        entries.append((st.st_atime, st.st_size, entry))
+            entries.sort()
+            while total > self.maxbytes and entries:
+                atime, size, entry = entries.pop(0)
+                log('Evicting %s' % entry)
+                os.remove(entry)
+                total -= size
+
+
+class CacheProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves objects out of self.server.cache'''
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'InstallApplicationsCacheProxy/1.0'
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        query = parse_qs(urlparse(self.path).query)
+        url = query.get('url', [None])[0]
+        hash = query.get('hash', [None])[0]
+        cache = self.server.cache
+        if not url or not cache.allowed(url):
+            self.send_error(400, 'Missing or disallowed url')
+            return
+        if hash and not re.match(r'^[0-9a-fA-F]{64}$', hash):
+            self.send_error(400, 'Malformed hash')
+            return
+        headers = {}
+        if self.headers.get('Authorization'):
+            headers['Authorization'] = self.headers['Authorization']
+        if not hash or not (body or os.path.isfile(cache.path(hash.lower()))):
+            # Without a hash we can't tell a good copy from a bad one, and a
+            # HEAD request shouldn't make us download the whole object.
+            self.relay(url, headers, body)
+            return
+        try:
+            source = cache.get(url, hash, headers)
+        except (IOError, urllib2.URLError) as err:
+            log('Could not fetch %s: %s' % (url, str(err)))
+            self.send_error(502, 'Could not fetch object from origin')
+            return
+        with source:
+            self.sendfile(source, hash.lower(), body)
+
+    def relay(self, url, headers, body):
+        '''Passes the request through to the origin without caching it'''
+        for name in ('Range', 'If-Range'):
+            if self.headers.get(name):
+                headers[name] = self.headers[name]
+        if body:
+            request = urllib2.Request(url, headers=headers)
+        else:
+            request = HeadRequest(url, headers=headers)
+        try:
+            response = self.server.cache.open(request)
+        except urllib2.HTTPError as err:
+            # An error response from the origin is still a response.
+            response = err
+        except (IOError, urllib2.URLError) as err:
+            log('Could not fetch %s: %s' % (url, str(err)))
+            self.send_error(502, 'Could not fetch object from origin')
+            return
+        try:
+            info = response.info()
+            self.send_response(response.getcode())
+            for name in RELAYED_HEADERS:
+                if info.getheader(name) is not None:
+                    self.send_header(name, info.getheader(name))
+            if info.getheader('Content-Length') is None:
+                # We can only mark the end of the body by closing.
+                self.send_header('Connection', 'close')
+                self.close_connection = 1
+            self.end_headers()
+            while body:
+                chunk = response.read(2**16)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+        finally:
+            response.close()
+
+    def sendfile(self, source, key, body):
+        '''Sends the cached object open as source, honoring a single byte
+        Range'''
+        st = os.fstat(source.fileno())
+        size = st.st_size
+        start, end = 0, size - 1
+        status = 200
+        byte_range = re.match(r'^bytes=(\d*)-(\d*)$',
+                              self.headers.get('Range', '').strip())
+        if byte_range and (byte_range.group(1) or byte_range.group(2)):
+            if byte_range.group(1):
+                start = int(byte_range.group(1))
+                if byte_range.group(2):
+                    end = min(int(byte_range.group(2)), size - 1)
+            else:
+                # suffix range: the last N bytes
+                start = max(0, size - int(byte_range.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s"' % key)
+        self.send_header('Last-Modified', formatdate(
+            st.st_mtime, usegmt=True))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, size))
+        self.end_headers()
+        if not body:
+            return
+        source.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = source.read(min(2**16, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        log('%s %s' % (self.address_string(), format % args))
+
+
+class CacheProxyServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheProxyHandler)
+        self.cache = cache
+
+
+def log(text):
+    sys.stderr.write('%s [CacheProxy] %s\n' % (
+        time.strftime('%Y-%m-%d %H:%M:%S'), text))
+
+
+def main():
+    usage = '%prog [options]'
+    o = optparse.OptionParser(usage=usage)
+    o.add_option('--address', default='0.0.0.0',
+                 help=('Optional: Address to listen on.'))
+    o.add_option('--port', default=8080, type='int',
+                 help=('Optional: Port to listen on.'))
+    o.add_option('--cache-dir', default='/var/tmp/installapplications-cache',
+                 help=('Optional: Directory to store cached objects in.'))
+    o.add_option('--cache-size', default=51200, type='int',
+                 help=('Optional: Maximum size of the cache in megabytes.'))
+    o.add_option('--allow-origin', default=[], action='append',
+                 dest='allowed_origins',
+                 help=('Required: Only fetch URLs under this scheme, host '
+                       'and path, e.g. https://domain.tld/pkgs/. Can be '
+                       'passed multiple times.'))
+    o.add_option('--timeout', default=60, type='int',
+                 help=('Optional: Timeout in seconds for origin requests.'))
+    opts, args = o.parse_args()
+
+    if not opts.allowed_origins:
+        o.error('--allow-origin is required, so the proxy is not an open '
+                'relay.')
+    for origin in opts.allowed_origins:
+        parsed = urlparse(origin)
+        if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            o.error('--allow-origin must be an http or https URL: %s'
+                    % origin)
+
+    cache = ObjectCache(opts.cache_dir, opts.cache_size * 1024 * 1024,
+                        opts.allowed_origins, opts.timeout)
+    server = CacheProxyServer((opts.address, opts.port), cache)
+    log('Serving %s on %s:%d' % (opts.cache_dir, opts.address,
+                                 server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
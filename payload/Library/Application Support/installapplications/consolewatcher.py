@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2018 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+consolewatcher.py
+
+Waits for a user session on the console. Instead of polling the console user
+every second, ConsoleUserWatcher asks its provider to call it back when the
+console user changes, and wakes up as soon as that happens:
+
+    watcher = ConsoleUserWatcher()
+    user, uid, gid = watcher.waitforsession()
+
+SCDynamicStoreProvider gets change notifications from the SystemConfiguration
+dynamic store.
+"""
+
+import threading
+import time
+
+try:
+    from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+except ImportError:
+    SCDynamicStoreCopyConsoleUser = None
+
+# Console "users" that mean nobody has logged in yet.
+NO_SESSION_USERS = (None, u'loginwindow', u'_mbsetupuser')
+
+
+class SCDynamicStoreProvider(object):
+    '''Reads the console user from the dynamic store and watches its console
+    user key for changes on a run loop thread of its own'''
+
+    def __init__(self):
+        self.thread = None
+
+    def current(self):
+        '''Returns (user, uid, gid) of the console user'''
+        return SCDynamicStoreCopyConsoleUser(None, None, None)
+
+    def watch(self, callback):
+        '''Calls callback whenever the console user changes. Returns False if
+        notifications aren't available and the caller has to poll.'''
+        try:
+            from CoreFoundation import (CFRunLoopAddSource,
+                                        CFRunLoopGetCurrent, CFRunLoopRun,
+                                        kCFRunLoopDefaultMode)
+            from SystemConfiguration import (
+                SCDynamicStoreCreate, SCDynamicStoreCreateRunLoopSource,
+                SCDynamicStoreKeyCreateConsoleUser,
+                SCDynamicStoreSetNotificationKeys)
+        except ImportError:
+            return False
+        started = threading.Event()
+        result = []
+
+        def run():
+            try:
+                store = SCDynamicStoreCreate(
+                    None, 'installapplications',
+                    lambda store, keys, info: callback(), None)
+                SCDynamicStoreSetNotificationKeys(
+                    store, [SCDynamicStoreKeyCreateConsoleUser(None)], None)
+                source = SCDynamicStoreCreateRunLoopSource(None, store, 0)
+                CFRunLoopAddSource(CFRunLoopGetCurrent(), source,
+                                   kCFRunLoopDefaultMode)
+            except Exception:
+                started.set()
+                return
+            result.append(store)
+            started.set()
+            CFRunLoopRun()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        return bool(result)
+
+
+class ConsoleUserWatcher(object):
+    '''Tells whether someone is logged in and waits until someone is'''
+
+    def __init__(self, provider=None, interval=1):
+        self.provider = provider or SCDynamicStoreProvider()
+        self.cond = threading.Condition()
+        # With notifications we only check now and then in case one was
+        # missed; without them we poll every interval seconds like we used
+        # to.
+        if self.provider.watch(self.changed):
+            self.interval = 30
+        else:
+            self.interval = interval
+
+    def changed(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def current(self):
+        '''Returns (user, uid, gid) of the console user'''
+        user = self.provider.current()
+        if user is None:
+            return (None, None, None)
+        return user
+
+    def insession(self):
+        '''Returns True if a real user is logged in on the console'''
+        return self.current()[0] not in NO_SESSION_USERS
+
+    def waitforsession(self, timeout=None):
+        '''Blocks until a real user is logged in and returns (user, uid, gid),
+        or None if timeout seconds pass first'''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                user = self.current()
+                if user[0] not in NO_SESSION_USERS:
+                    return user
+                interval = self.interval
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    interval = min(interval, remaining)
+                self.cond.wait(interval)
@@ -20,30 +20,62 @@ Created by Greg Neagle on 2013-11-21.
 Modified in Feb 2016 to add support for NSURLSession.
 
 curl replacement using NSURLConnection and friends
+
+There are two transports behind the same interface. Gurl uses
+NSURLSession (or NSURLConnection on older systems), with one session shared
+by every download in the process except the segments of a segmented
+download, which each get their own. HTTPGurl is pure Python, using httplib
+with a pool of keep-alive connections, and works without PyObjC. connection()
+returns one for the transport picked with set_transport().
+
+Compressed bodies are decompressed as they are received, before they are
+hashed and written, whether the server sent them with a Content-Encoding or
+the file itself is compressed and the caller says so with the compression
+option. zstd needs the zstandard module.
 """
 
+import base64
+import hashlib
+import httplib
 import os
-import xattr
-from urlparse import urlparse
+import plistlib
+import socket
+import sys
+import threading
+import time
+import zlib
+from urlparse import urljoin, urlparse
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
 
-# builtin super doesn't work with Cocoa classes in recent PyObjC releases.
-from objc import super
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
 # pylint: disable=E0611
 
-
-from Foundation import (NSBundle, NSRunLoop, NSDate,
-                        NSObject, NSURL, NSURLConnection,
-                        NSMutableURLRequest,
-                        NSURLRequestReloadIgnoringLocalCacheData,
-                        NSURLResponseUnknownLength,
-                        NSLog,
-                        NSURLCredential, NSURLCredentialPersistenceNone,
-                        NSPropertyListSerialization,
-                        NSPropertyListMutableContainersAndLeaves,
-                        NSPropertyListXMLFormat_v1_0)
+try:
+    from Foundation import (NSBundle, NSRunLoop, NSDate, NSDefaultRunLoopMode,
+                            NSObject, NSURL, NSURLConnection,
+                            NSMutableURLRequest,
+                            NSURLRequestReloadIgnoringLocalCacheData,
+                            NSLog,
+                            NSURLCredential, NSURLCredentialPersistenceNone)
+    # builtin super doesn't work with Cocoa classes in recent PyObjC
+    # releases.
+    from objc import super
+    FOUNDATION_AVAILABLE = True
+except ImportError:
+    # Only HTTPGurl can be used.
+    class NSObject(object):
+        '''Stands in for NSObject so Gurl can still be defined'''
+    FOUNDATION_AVAILABLE = False
 
 try:
     from Foundation import NSURLSession, NSURLSessionConfiguration
@@ -93,16 +125,56 @@ if NSURLSESSION_AVAILABLE:
 
 # pylint: enable=E0611
 
-# disturbing hack warning!
-# this works around an issue with App Transport Security on 10.11
-bundle = NSBundle.mainBundle()
-info = bundle.localizedInfoDictionary() or bundle.infoDictionary()
-info['NSAppTransportSecurity'] = {'NSAllowsArbitraryLoads': True}
+if FOUNDATION_AVAILABLE:
+    # disturbing hack warning!
+    # this works around an issue with App Transport Security on 10.11
+    bundle = NSBundle.mainBundle()
+    info = bundle.localizedInfoDictionary() or bundle.infoDictionary()
+    info['NSAppTransportSecurity'] = {'NSAllowsArbitraryLoads': True}
+
+# NSURLResponseUnknownLength
+UNKNOWN_LENGTH = -1
+
+# NSURLErrorDomain codes HTTPGurl reports its errors with
+NSURLErrorUnknown = -1
+NSURLErrorCancelled = -999
+NSURLErrorTimedOut = -1001
+NSURLErrorUnsupportedURL = -1002
+NSURLErrorCannotConnectToHost = -1004
+NSURLErrorNetworkConnectionLost = -1005
+
+# Stored headers of downloads, by path, when there is no xattr module.
+g_stored_headers = {}
+
+# Content codings we can decompress, in the order we prefer them
+ENCODINGS = ['gzip']
+if zstandard is not None:
+    ENCODINGS.insert(0, 'zstd')
+
+DECODE_ERRORS = (zlib.error,)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+def decoder(encoding):
+    '''Returns an object whose decompress() and flush() methods undo
+    encoding a chunk at a time, or None if we can't undo it'''
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
 
 
 def NSLogWrapper(message):
     '''A wrapper function for NSLog to prevent format string errors'''
-    NSLog('%@', message)
+    if FOUNDATION_AVAILABLE:
+        NSLog('%@', message)
+    else:
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        sys.stderr.write(message + '\n')
 
 
 ssl_error_codes = {
@@ -158,25 +230,15 @@ ssl_error_codes = {
     -9849: u'Unexpected (skipped) record in DTLS'}
 
 
-class Gurl(NSObject):
-    '''A class for getting content from a URL
-       using NSURLConnection/NSURLSession and friends'''
-
-    # since we inherit from NSObject, PyLint issues a few bogus warnings
-    # pylint: disable=W0232,E1002
-
-    # Don't want to define the attributes twice that are initialized in
-    # initWithOptions_(), so:
-    # pylint: disable=E1101,W0201
+class GurlBase(object):
+    '''The parts of a download that don't depend on the transport: options,
+    request headers, what to do with a response and its data, hashing,
+    stored headers and waiting for completion'''
 
     GURL_XATTR = 'com.googlecode.munki.downloadData'
 
-    def initWithOptions_(self, options):
-        '''Set up our Gurl object'''
-        self = super(Gurl, self).init()
-        if not self:
-            return
-
+    def setupWithOptions(self, options):
+        '''Set up our options and state'''
         self.follow_redirects = options.get('follow_redirects', False)
         self.ignore_system_proxy = options.get('ignore_system_proxy', False)
         self.destination_path = options.get('file')
@@ -189,131 +251,169 @@ class Gurl(NSObject):
             'download_only_if_changed', False)
         self.cache_data = options.get('cache_data')
         self.connection_timeout = options.get('connection_timeout', 60)
-        if NSURLSESSION_AVAILABLE:
-            self.minimum_tls_protocol = options.get(
-                'minimum_tls_protocol', kTLSProtocol1)
+        self.method = options.get('method')
+        self.byte_range = options.get('byte_range')
+        self.expected_hash = options.get('expected_hash')
+        self.hash_algorithm = options.get('hash_algorithm')
+        if self.expected_hash and not self.hash_algorithm:
+            self.hash_algorithm = 'sha256'
+        # the file on the server is compressed with this and we want it
+        # decompressed
+        self.compression = options.get('compression')
+        # ask the server to compress what it sends
+        self.accept_encoding = options.get('accept_encoding', False)
+        # sha256 digests of each chunk_size bytes of the file, checked as
+        # the file is written
+        self.chunk_size = options.get('chunk_size')
+        self.chunk_hashes = options.get('chunk_hashes')
 
         self.log = options.get('logging_function', NSLogWrapper)
+        self.completion_callback = options.get('completion_callback')
 
         self.resume = False
+        self.content_changed = False
+        self.range_unsupported = False
         self.response = None
         self.headers = None
         self.status = None
         self.error = None
         self.SSLerror = None
         self.done = False
+        self.condition = threading.Condition()
+        self.events = 0
+        self.seen_events = 0
         self.redirection = []
         self.destination = None
         self.bytesReceived = 0
         self.expectedLength = -1
         self.percentComplete = 0
-        self.connection = None
-        self.session = None
-        self.task = None
-        return self
-
-    def start(self):
-        '''Start the connection'''
-        if not self.destination_path:
-            self.log('No output file specified.')
-            self.done = True
-            return
-        url = NSURL.URLWithString_(self.url)
-        request = (
-            NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(
-                url, NSURLRequestReloadIgnoringLocalCacheData,
-                self.connection_timeout))
-        if self.additional_headers:
-            for header, value in self.additional_headers.items():
-                request.setValue_forHTTPHeaderField_(value, header)
+        # bytes that came over the network, unlike bytesReceived which
+        # includes the part of a resumed download we already had
+        self.bytes_transferred = 0
+        self.first_byte_time = None
+        self.hasher = None
+        self.digest = None
+        self.digest_verified = None
+        # the coding of the body as it reaches receiveData, if the
+        # transport knows it had one
+        self.content_encoding = None
+        self.decoders = []
+        self.decode_failed = False
+        # indexes of the chunks that didn't match chunk_hashes, once we
+        # start checking them
+        self.bad_chunks = None
+        self.chunk_hasher = None
+        self.chunk_index = 0
+        self.chunk_filled = 0
+
+    def requestHeaders(self):
+        '''Returns the headers to send with our request, deciding whether we
+        are resuming a partial download on the way'''
+        headers = dict(self.additional_headers or {})
+        if self.byte_range:
+            # we're fetching one segment of a file someone else has
+            # preallocated, so there is nothing to resume or revalidate
+            headers['Range'] = 'bytes=%s-%s' % tuple(self.byte_range)
         # does the file already exist? See if we can resume a partial download
-        if os.path.isfile(self.destination_path):
+        elif os.path.isfile(self.destination_path):
             stored_data = self.get_stored_headers()
             if (self.can_resume and 'expected-length' in stored_data and
-                    ('last-modified' in stored_data or 'etag' in stored_data)):
+                    ('last-modified' in stored_data or 'etag' in stored_data)
+                    and not self.compression
+                    and 'content-encoding' not in stored_data):
+                # (a decompressed partial file doesn't tell us where to pick
+                # up in the compressed one, so those start over)
                 # we have a partial file and we're allowed to resume
                 self.resume = True
                 local_filesize = os.path.getsize(self.destination_path)
-                byte_range = 'bytes=%s-' % local_filesize
-                request.setValue_forHTTPHeaderField_(byte_range, 'Range')
-        if self.download_only_if_changed and not self.resume:
+                headers['Range'] = 'bytes=%s-' % local_filesize
+        if (self.download_only_if_changed and not self.resume
+                and not self.byte_range):
             stored_data = self.cache_data or self.get_stored_headers()
+            if 'expected-length' in stored_data:
+                # the last download of this file never finished, so don't
+                # let the server tell us it's unchanged
+                stored_data = {}
             if 'last-modified' in stored_data:
-                request.setValue_forHTTPHeaderField_(
-                    stored_data['last-modified'], 'if-modified-since')
+                headers['if-modified-since'] = stored_data['last-modified']
             if 'etag' in stored_data:
-                request.setValue_forHTTPHeaderField_(
-                    stored_data['etag'], 'if-none-match')
-        if NSURLSESSION_AVAILABLE:
-            configuration = \
-                NSURLSessionConfiguration.defaultSessionConfiguration()
+                headers['if-none-match'] = stored_data['etag']
+        return headers
 
-            # optional: ignore system http/https proxies (10.9+ only)
-            if self.ignore_system_proxy is True:
-                configuration.setConnectionProxyDictionary_(
-                    {kCFNetworkProxiesHTTPEnable: False,
-                     kCFNetworkProxiesHTTPSEnable: False})
-
-            # set minumum supported TLS protocol (defaults to TLS1)
-            configuration.setTLSMinimumSupportedProtocol_(
-                self.minimum_tls_protocol)
-
-            self.session = \
-                NSURLSession.sessionWithConfiguration_delegate_delegateQueue_(
-                    configuration, self, None)
-            self.task = self.session.dataTaskWithRequest_(request)
-            self.task.resume()
+    def redirectAllowed(self, newURL):
+        '''Returns True if follow_redirects lets us follow a redirect to
+        newURL'''
+        # This code was largely based on the work of Andreas Fuchs
+        # (https://github.com/munki/munki/pull/465)
+        if self.follow_redirects is True or self.follow_redirects == 'all':
+            # Allow the redirect
+            allowed = True
+        elif (self.follow_redirects == 'https'
+              and urlparse(newURL).scheme == 'https'):
+            # Once again, allow the redirect
+            allowed = True
         else:
-            self.connection = NSURLConnection.alloc().initWithRequest_delegate_(
-                request, self)
+            # If we're down here either the preference was set to 'none',
+            # the url we're forwarding on to isn't https or follow_redirects
+            # was explicitly set to False
+            allowed = False
+        if allowed:
+            self.log('Allowing redirect to: %s' % newURL)
+        else:
+            self.log('Denying redirect to: %s' % newURL)
+        return allowed
+
+    def wait(self, timeout=None):
+        '''Block until the connection request is complete or has reported
+        progress since the last call, or until timeout seconds have passed.
+        Returns True once the connection request is complete'''
+        with self.condition:
+            if not self.done and self.events == self.seen_events:
+                self.condition.wait(timeout)
+            self.seen_events = self.events
+            return self.done
 
-    def cancel(self):
-        '''Cancel the connection'''
-        if self.connection:
-            if NSURLSESSION_AVAILABLE:
-                self.session.invalidateAndCancel()
-            else:
-                self.connection.cancel()
+    def notifyProgress(self):
+        '''Wake up anyone blocked in wait()'''
+        with self.condition:
+            self.events += 1
+            self.condition.notify_all()
+
+    def finish(self):
+        '''Mark the connection request as complete, wake up anyone blocked in
+        wait() and call the completion callback'''
+        with self.condition:
+            if self.done:
+                return
             self.done = True
-
-    def isDone(self):
-        '''Check if the connection request is complete. As a side effect,
-        allow the delegates to work by letting the run loop run for a bit'''
-        if self.done:
-            return self.done
-        # let the delegates do their thing
-        NSRunLoop.currentRunLoop().runUntilDate_(
-            NSDate.dateWithTimeIntervalSinceNow_(.1))
-        return self.done
+            self.condition.notify_all()
+        if self.completion_callback:
+            self.completion_callback(self)
 
     def get_stored_headers(self):
         '''Returns any stored headers for self.destination_path'''
         # try to read stored headers
+        if xattr is None:
+            return dict(g_stored_headers.get(self.destination_path, {}))
         try:
             stored_plist_str = xattr.getxattr(
                 self.destination_path, self.GURL_XATTR)
         except (KeyError, IOError):
             return {}
-        data = buffer(stored_plist_str)
-        dataObject, plistFormat, error = (
-            NSPropertyListSerialization.
-            propertyListFromData_mutabilityOption_format_errorDescription_(
-                data, NSPropertyListMutableContainersAndLeaves, None, None))
-        if error:
+        try:
+            return plistlib.readPlistFromString(stored_plist_str)
+        except Exception:
             return {}
-        else:
-            return dataObject
 
     def store_headers(self, headers):
         '''Store dictionary data as an xattr for self.destination_path'''
-        plistData, error = (
-            NSPropertyListSerialization.
-            dataFromPropertyList_format_errorDescription_(
-                headers, NSPropertyListXMLFormat_v1_0, None))
-        if error:
+        if xattr is None:
+            g_stored_headers[self.destination_path] = dict(headers)
+            return
+        try:
+            string = plistlib.writePlistToString(headers)
+        except Exception:
             string = ''
-        else:
-            string = str(plistData)
         try:
             xattr.setxattr(self.destination_path, self.GURL_XATTR, string)
         except IOError, err:
@@ -333,6 +433,318 @@ class Gurl(NSObject):
             new_dict[key.lower()] = value
         return new_dict
 
+    def removeExpectedSizeFromStoredHeaders(self):
+        '''If a successful transfer, clear the expected size so we
+        don\'t attempt to resume the download next time'''
+        if self.byte_range:
+            # segments don't store any headers
+            return
+        if str(self.status).startswith('2'):
+            # remove the expected-size from the stored headers
+            headers = self.get_stored_headers()
+            if 'expected-length' in headers:
+                del headers['expected-length']
+                self.store_headers(headers)
+
+    def startDigest(self):
+        '''Set up a hash object for the data we are about to write to
+        self.destination_path, and start checking its chunks if we were
+        given chunk_hashes. If we are resuming, seed them with the bytes
+        already on disk'''
+        self.hasher = None
+        self.bad_chunks = None
+        if self.hash_algorithm:
+            self.hasher = hashlib.new(self.hash_algorithm)
+            self.digest = None
+            self.digest_verified = None
+        if self.chunk_size and self.chunk_hashes:
+            self.bad_chunks = []
+            self.chunk_hasher = hashlib.sha256()
+            self.chunk_index = 0
+            self.chunk_filled = 0
+        if self.resume and (self.hasher or self.bad_chunks is not None):
+            with open(self.destination_path, 'rb') as fileref:
+                while 1:
+                    chunk = fileref.read(2**16)
+                    if not chunk:
+                        break
+                    self.updateDigest(chunk)
+
+    def updateDigest(self, data):
+        '''Add data written to self.destination_path to the digest and the
+        chunk being checked'''
+        if self.hasher:
+            self.hasher.update(data)
+        while self.bad_chunks is not None and data:
+            size = min(len(data), self.chunk_size - self.chunk_filled)
+            self.chunk_hasher.update(data[:size])
+            self.chunk_filled += size
+            data = data[size:]
+            if self.chunk_filled == self.chunk_size:
+                self.finishChunk()
+
+    def finishChunk(self):
+        '''Compare the chunk we just finished against its digest'''
+        index = self.chunk_index
+        if (index >= len(self.chunk_hashes) or
+                self.chunk_hasher.hexdigest() !=
+                self.chunk_hashes[index].lower()):
+            self.bad_chunks.append(index)
+        self.chunk_hasher = hashlib.sha256()
+        self.chunk_index += 1
+        self.chunk_filled = 0
+
+    def finishDigest(self):
+        '''Record the digest of everything written to self.destination_path
+        and compare it against the expected digest, if we were given one'''
+        if self.bad_chunks is not None:
+            if self.chunk_filled:
+                # the last chunk is usually short
+                self.finishChunk()
+            # and any we never got are bad too
+            self.bad_chunks.extend(
+                range(self.chunk_index, len(self.chunk_hashes)))
+        if not self.hasher:
+            return
+        self.digest = self.hasher.hexdigest()
+        self.hasher = None
+        if self.expected_hash:
+            self.digest_verified = (
+                self.digest.lower() == self.expected_hash.lower())
+            if not self.digest_verified and self.error is None:
+                self.log('Hash mismatch for %s - received: %s expected: %s'
+                         % (self.destination_path, self.digest,
+                            self.expected_hash))
+
+    def openDestination(self, download_data):
+        '''Get ready to write the body of the response whose status and
+        headers we just recorded. Returns False if the transfer should be
+        cancelled.'''
+        # self.destination is defined in setupWithOptions
+        # pylint: disable=E0203
+
+        if self.method == 'HEAD':
+            # there is no body to write
+            pass
+        elif self.byte_range:
+            if self.status == 206:
+                # write our segment into its place in the preallocated file
+                self.destination = open(self.destination_path, 'r+b')
+                self.destination.seek(self.byte_range[0])
+            elif str(self.status).startswith('2'):
+                # the server ignored our Range header and would send us the
+                # whole file
+                self.log('Server does not support byte ranges for %s'
+                         % self.url)
+                self.range_unsupported = True
+                return False
+        elif not self.destination and self.destination_path:
+            if self.status == 206 and self.resume:
+                # 206 is Partial Content response
+                stored_data = self.get_stored_headers()
+                if (not stored_data or
+                        stored_data.get('etag') != download_data.get('etag') or
+                        stored_data.get('last-modified') != download_data.get(
+                            'last-modified')):
+                    # file on server is different than the one
+                    # we have a partial for
+                    self.log(
+                        'Can\'t resume download; file on server has changed.')
+                    self.content_changed = True
+                    self.log('Removing %s' % self.destination_path)
+                    os.unlink(self.destination_path)
+                    # the caller needs to start over and download the entire
+                    # file
+                    return False
+                # try to resume
+                self.log('Resuming download for %s' % self.destination_path)
+                # add existing file size to bytesReceived so far
+                local_filesize = os.path.getsize(self.destination_path)
+                self.bytesReceived = local_filesize
+                self.expectedLength += local_filesize
+                # open file for append
+                self.destination = open(self.destination_path, 'a')
+                self.startDigest()
+
+            elif str(self.status).startswith('2'):
+                # not resuming (or the server ignored our Range request),
+                # just open the file for writing
+                self.resume = False
+                self.destination = open(self.destination_path, 'w')
+                self.startDigest()
+                if not self.startDecoding():
+                    self.destination.close()
+                    self.destination = None
+                    return False
+                if self.decoders or self.content_encoding is not None:
+                    # what we wrote is not the bytes the server would send
+                    # for a byte range, whoever decoded them
+                    download_data['content-encoding'] = True
+                # store some headers with the file for use if we need to resume
+                # the downloadand for future checking if the file on the server
+                # has changed
+                self.store_headers(download_data)
+        return True
+
+    def startDecoding(self):
+        '''Set up decompression of the body we are about to write. Returns
+        False if it is compressed in a way we can't undo.'''
+        self.decoders = []
+        self.decode_failed = False
+        if self.content_encoding is not None:
+            # the server told us how the body is compressed, which covers a
+            # compressed file served with a Content-Encoding too
+            encoding = self.content_encoding
+        else:
+            encoding = self.compression
+        if not encoding or encoding.lower() == 'identity':
+            return True
+        body_decoder = decoder(encoding)
+        if body_decoder is None:
+            self.log('Can\'t decompress %s: unsupported compression %s'
+                     % (self.url, encoding))
+            return False
+        self.decoders.append(body_decoder)
+        return True
+
+    def writeData(self, data, final=False):
+        '''Decompress data if we need to, then write and hash it'''
+        if self.decode_failed:
+            return
+        try:
+            for body_decoder in self.decoders:
+                data = body_decoder.decompress(data)
+                if final:
+                    data += body_decoder.flush()
+        except DECODE_ERRORS, err:
+            # what we write from now on would be garbage anyway; the hash
+            # check will fail
+            self.log('Could not decompress %s: %s' % (self.url, err))
+            self.decode_failed = True
+            return
+        if data:
+            self.destination.write(data)
+            self.updateDigest(data)
+
+    def receiveData(self, chunk):
+        '''Write a chunk of the response body'''
+        if self.destination:
+            self.writeData(chunk)
+        else:
+            self.log(chunk.decode('UTF-8'))
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time()
+        # these count bytes as they came over the network, before they are
+        # decompressed
+        self.bytes_transferred += len(chunk)
+        self.bytesReceived += len(chunk)
+        if self.expectedLength != UNKNOWN_LENGTH:
+            self.percentComplete = int(
+                float(self.bytesReceived)/float(self.expectedLength) * 100.0)
+        self.notifyProgress()
+
+    def completeWithError(self, error):
+        '''Close the destination file and mark the connection request as
+        complete. error is None if the transfer succeeded.'''
+        if self.destination and self.destination_path:
+            if self.decoders and not error:
+                self.writeData('', final=True)
+            self.destination.close()
+            self.finishDigest()
+            if not error:
+                # keep the expected size of an interrupted transfer around
+                # so we can resume it
+                self.removeExpectedSizeFromStoredHeaders()
+        self.finish()
+
+
+class Gurl(NSObject, GurlBase):
+    '''A class for getting content from a URL
+       using NSURLConnection/NSURLSession and friends'''
+
+    # since we inherit from NSObject, PyLint issues a few bogus warnings
+    # pylint: disable=W0232,E1002
+
+    # Don't want to define the attributes twice that are initialized in
+    # initWithOptions_(), so:
+    # pylint: disable=E1101,W0201
+
+    def initWithOptions_(self, options):
+        '''Set up our Gurl object'''
+        self = super(Gurl, self).init()
+        if not self:
+            return
+
+        self.setupWithOptions(options)
+        if NSURLSESSION_AVAILABLE:
+            self.minimum_tls_protocol = options.get(
+                'minimum_tls_protocol', kTLSProtocol1)
+        self.connection = None
+        self.session = None
+        self.task = None
+        return self
+
+    def start(self):
+        '''Start the connection'''
+        if not self.destination_path:
+            self.log('No output file specified.')
+            self.finish()
+            return
+        url = NSURL.URLWithString_(self.url)
+        request = (
+            NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(
+                url, NSURLRequestReloadIgnoringLocalCacheData,
+                self.connection_timeout))
+        if self.method:
+            request.setHTTPMethod_(self.method)
+        for header, value in self.requestHeaders().items():
+            request.setValue_forHTTPHeaderField_(value, header)
+        if NSURLSESSION_AVAILABLE:
+            # Every Gurl shares a session, so connections to the same server
+            # are reused instead of paying for a new TLS handshake.
+            self.task = g_dispatcher.dataTaskWithRequest_forGurl_(
+                request, self)
+            self.task.resume()
+        else:
+            self.connection = NSURLConnection.alloc().initWithRequest_delegate_(
+                request, self)
+
+    def cancel(self):
+        '''Cancel the connection'''
+        if self.task:
+            self.task.cancel()
+        elif self.connection:
+            self.connection.cancel()
+        self.finish()
+
+    def isDone(self):
+        '''Check if the connection request is complete. As a side effect,
+        allow the delegates to work by letting the run loop run for a bit'''
+        if self.done:
+            return self.done
+        # let the delegates do their thing
+        NSRunLoop.currentRunLoop().runUntilDate_(
+            NSDate.dateWithTimeIntervalSinceNow_(.1))
+        return self.done
+
+    def wait(self, timeout=None):
+        '''Block until the connection request is complete or has reported
+        progress since the last call, or until timeout seconds have passed.
+        Returns True once the connection request is complete'''
+        if not NSURLSESSION_AVAILABLE:
+            # NSURLConnection delivers its delegate messages on this thread's
+            # run loop, so run it until it has handled one of them.
+            if timeout is None:
+                limit = NSDate.distantFuture()
+            else:
+                limit = NSDate.dateWithTimeIntervalSinceNow_(timeout)
+            if not self.done:
+                NSRunLoop.currentRunLoop().runMode_beforeDate_(
+                    NSDefaultRunLoopMode, limit)
+            return self.done
+        # NSURLSession delegate messages arrive on the session's own queue
+        return GurlBase.wait(self, timeout)
+
     def recordError_(self, error):
         '''Record any error info from completed connection/session'''
         self.error = error
@@ -344,26 +756,13 @@ class Gurl(NSObject):
                 self.SSLerror = (ssl_code, ssl_error_codes.get(
                     ssl_code, 'Unknown SSL error'))
 
-    def removeExpectedSizeFromStoredHeaders(self):
-        '''If a successful transfer, clear the expected size so we
-        don\'t attempt to resume the download next time'''
-        if str(self.status).startswith('2'):
-            # remove the expected-size from the stored headers
-            headers = self.get_stored_headers()
-            if 'expected-length' in headers:
-                del headers['expected-length']
-                self.store_headers(headers)
-
     def URLSession_task_didCompleteWithError_(self, session, task, error):
         '''NSURLSessionTaskDelegate method.'''
         # we don't actually use the session or task arguments, so
         # pylint: disable=W0613
-        if self.destination and self.destination_path:
-            self.destination.close()
-            self.removeExpectedSizeFromStoredHeaders()
         if error:
             self.recordError_(error)
-        self.done = True
+        self.completeWithError(error)
 
     def connection_didFailWithError_(self, connection, error):
         '''NSURLConnectionDelegate method
@@ -371,9 +770,7 @@ class Gurl(NSObject):
         # we don't actually use the connection argument, so
         # pylint: disable=W0613
         self.recordError_(error)
-        self.done = True
-        if self.destination and self.destination_path:
-            self.destination.close()
+        self.completeWithError(error)
 
     def connectionDidFinishLoading_(self, connection):
         '''NSURLConnectionDataDelegate method
@@ -382,10 +779,7 @@ class Gurl(NSObject):
         # we don't actually use the connection argument, so
         # pylint: disable=W0613
 
-        self.done = True
-        if self.destination and self.destination_path:
-            self.destination.close()
-            self.removeExpectedSizeFromStoredHeaders()
+        self.completeWithError(None)
 
     def handleResponse_withCompletionHandler_(
             self, response, completionHandler):
@@ -407,55 +801,23 @@ class Gurl(NSObject):
             if 'etag' in normalized_headers:
                 download_data['etag'] = normalized_headers['etag']
             download_data['expected-length'] = self.expectedLength
+            if 'content-encoding' in normalized_headers:
+                # Foundation has already decompressed the body for us
+                self.content_encoding = 'identity'
 
-        # self.destination is defined in initWithOptions_
-        # pylint: disable=E0203
-
-        if not self.destination and self.destination_path:
-            if self.status == 206 and self.resume:
-                # 206 is Partial Content response
-                stored_data = self.get_stored_headers()
-                if (not stored_data or
-                        stored_data.get('etag') != download_data.get('etag') or
-                        stored_data.get('last-modified') != download_data.get(
-                            'last-modified')):
-                    # file on server is different than the one
-                    # we have a partial for
-                    self.log(
-                        'Can\'t resume download; file on server has changed.')
-                    if completionHandler:
-                        # tell the session task to cancel
-                        completionHandler(NSURLSessionResponseCancel)
-                    else:
-                        # cancel the connection
-                        self.connection.cancel()
-                    self.log('Removing %s' % self.destination_path)
-                    os.unlink(self.destination_path)
-                    # restart and attempt to download the entire file
-                    self.log(
-                        'Restarting download of %s' % self.destination_path)
-                    os.unlink(self.destination_path)
-                    self.start()
-                    return
-                # try to resume
-                self.log('Resuming download for %s' % self.destination_path)
-                # add existing file size to bytesReceived so far
-                local_filesize = os.path.getsize(self.destination_path)
-                self.bytesReceived = local_filesize
-                self.expectedLength += local_filesize
-                # open file for append
-                self.destination = open(self.destination_path, 'a')
-
-            elif str(self.status).startswith('2'):
-                # not resuming, just open the file for writing
-                self.destination = open(self.destination_path, 'w')
-                # store some headers with the file for use if we need to resume
-                # the downloadand for future checking if the file on the server
-                # has changed
-                self.store_headers(download_data)
+        if not self.openDestination(download_data):
+            if completionHandler:
+                # tell the session task to cancel
+                completionHandler(NSURLSessionResponseCancel)
+            else:
+                # cancel the connection
+                self.connection.cancel()
+                self.finish()
+            return
         if completionHandler:
             # tell the session task to continue
             completionHandler(NSURLSessionResponseAllow)
+        self.notifyProgress()
 
     def URLSession_dataTask_didReceiveResponse_completionHandler_(
             self, session, task, response, completionHandler):
@@ -500,36 +862,13 @@ class Gurl(NSObject):
         # to redirect and where the new location is.
         newURL = request.URL().absoluteString()
         self.redirection.append([newURL, dict(response.allHeaderFields())])
-        newParsedURL = urlparse(newURL)
-        # This code was largely based on the work of Andreas Fuchs
-        # (https://github.com/munki/munki/pull/465)
-        if self.follow_redirects is True or self.follow_redirects == 'all':
-            # Allow the redirect
-            self.log('Allowing redirect to: %s' % newURL)
-            if completionHandler:
-                completionHandler(request)
-                return
-            else:
-                return request
-        elif (self.follow_redirects == 'https'
-              and newParsedURL.scheme == 'https'):
-            # Once again, allow the redirect
-            self.log('Allowing redirect to: %s' % newURL)
-            if completionHandler:
-                completionHandler(request)
-                return
-            else:
-                return request
+        if not self.redirectAllowed(newURL):
+            request = None
+        if completionHandler:
+            completionHandler(request)
+            return
         else:
-            # If we're down here either the preference was set to 'none',
-            # the url we're forwarding on to isn't https or follow_redirects
-            # was explicitly set to False
-            self.log('Denying redirect to: %s' % newURL)
-            if completionHandler:
-                completionHandler(None)
-                return
-            else:
-                return None
+            return request
 
     def URLSession_task_willPerformHTTPRedirection_newRequest_completionHandler_(
             self, session, task, response, request, completionHandler):
@@ -673,14 +1012,7 @@ class Gurl(NSObject):
 
     def handleReceivedData_(self, data):
         '''Handle received data'''
-        if self.destination:
-            self.destination.write(str(data))
-        else:
-            self.log(str(data).decode('UTF-8'))
-        self.bytesReceived += len(data)
-        if self.expectedLength != NSURLResponseUnknownLength:
-            self.percentComplete = int(
-                float(self.bytesReceived)/float(self.expectedLength) * 100.0)
+        self.receiveData(str(data))
 
     def URLSession_dataTask_didReceiveData_(self, session, task, data):
         '''NSURLSessionDataDelegate method'''
@@ -696,5 +1028,424 @@ class Gurl(NSObject):
         self.handleReceivedData_(data)
 
 
+if NSURLSESSION_AVAILABLE:
+    class SessionDispatcher(NSObject):
+        '''The delegate of the NSURLSessions Gurls use. Passes each delegate
+        message on to the Gurl whose task it is about.'''
+
+        # since we inherit from NSObject, PyLint issues a few bogus warnings
+        # pylint: disable=W0232,E1002,E1101,W0201
+
+        def init(self):
+            '''Set up our SessionDispatcher object'''
+            self = super(SessionDispatcher, self).init()
+            if not self:
+                return
+            self.lock = threading.Lock()
+            # one session for each combination of session settings a Gurl
+            # can ask for
+            self.sessions = {}
+            self.gurls = {}
+            return self
+
+        def createSessionForGurl_(self, gurl):
+            '''Returns a new session with the settings gurl asks for'''
+            configuration = \
+                NSURLSessionConfiguration.defaultSessionConfiguration()
+
+            # optional: ignore system http/https proxies (10.9+ only)
+            if gurl.ignore_system_proxy is True:
+                configuration.setConnectionProxyDictionary_(
+                    {kCFNetworkProxiesHTTPEnable: False,
+                     kCFNetworkProxiesHTTPSEnable: False})
+
+            # set minumum supported TLS protocol (defaults to TLS1)
+            configuration.setTLSMinimumSupportedProtocol_(
+                gurl.minimum_tls_protocol)
+
+            return (NSURLSession.
+                    sessionWithConfiguration_delegate_delegateQueue_(
+                        configuration, self, None))
+
+        def sessionForGurl_(self, gurl):
+            '''Returns the session for the settings gurl asks for, creating
+            it the first time they are asked for'''
+            key = (gurl.ignore_system_proxy is True,
+                   gurl.minimum_tls_protocol)
+            with self.lock:
+                if key not in self.sessions:
+                    self.sessions[key] = self.createSessionForGurl_(gurl)
+                return self.sessions[key]
+
+        def dataTaskWithRequest_forGurl_(self, request, gurl):
+            '''Returns a task for request whose delegate messages go to
+            gurl'''
+            if gurl.byte_range:
+                # Every session delivers its delegate messages on one serial
+                # queue, so segments sharing a session would be written and
+                # hashed one at a time. Give each its own, which goes away
+                # once the segment is done.
+                session = self.createSessionForGurl_(gurl)
+            else:
+                session = self.sessionForGurl_(gurl)
+            gurl.session = session
+            task = session.dataTaskWithRequest_(request)
+            with self.lock:
+                self.gurls[task] = gurl
+            if gurl.byte_range:
+                session.finishTasksAndInvalidate()
+            return task
+
+        def gurlForTask_(self, task):
+            '''Returns the Gurl task belongs to'''
+            with self.lock:
+                return self.gurls.get(task)
+
+        def URLSession_task_didCompleteWithError_(self, session, task, error):
+            '''NSURLSessionTaskDelegate method.'''
+            with self.lock:
+                gurl = self.gurls.pop(task, None)
+            if gurl:
+                gurl.URLSession_task_didCompleteWithError_(
+                    session, task, error)
+
+        def URLSession_dataTask_didReceiveResponse_completionHandler_(
+                self, session, task, response, completionHandler):
+            '''NSURLSessionDataDelegate method'''
+            gurl = self.gurlForTask_(task)
+            if gurl:
+                gurl.URLSession_dataTask_didReceiveResponse_completionHandler_(
+                    session, task, response, completionHandler)
+            else:
+                completionHandler.__block_signature__ = (
+                    objc_method_signature('v@i'))
+                completionHandler(NSURLSessionResponseCancel)
+
+        def URLSession_task_willPerformHTTPRedirection_newRequest_completionHandler_(
+                self, session, task, response, request, completionHandler):
+            '''NSURLSessionTaskDelegate method'''
+            gurl = self.gurlForTask_(task)
+            if gurl:
+                gurl.URLSession_task_willPerformHTTPRedirection_newRequest_completionHandler_(
+                    session, task, response, request, completionHandler)
+            else:
+                completionHandler.__block_signature__ = (
+                    objc_method_signature('v@@'))
+                completionHandler(None)
+
+        def URLSession_task_didReceiveChallenge_completionHandler_(
+                self, session, task, challenge, completionHandler):
+            '''NSURLSessionTaskDelegate method'''
+            gurl = self.gurlForTask_(task)
+            if gurl:
+                gurl.URLSession_task_didReceiveChallenge_completionHandler_(
+                    session, task, challenge, completionHandler)
+            else:
+                completionHandler.__block_signature__ = (
+                    objc_method_signature('v@i@'))
+                completionHandler(
+                    NSURLSessionAuthChallengePerformDefaultHandling, None)
+
+        def URLSession_dataTask_didReceiveData_(self, session, task, data):
+            '''NSURLSessionDataDelegate method'''
+            gurl = self.gurlForTask_(task)
+            if gurl:
+                gurl.URLSession_dataTask_didReceiveData_(session, task, data)
+
+    g_dispatcher = SessionDispatcher.alloc().init()
+
+
+class HTTPError(object):
+    '''An error from an HTTPGurl. Answers the same questions as the NSError
+    a Gurl records.'''
+
+    def __init__(self, code, description):
+        self._code = code
+        self.description = description
+
+    def code(self):
+        '''Returns the NSURLErrorDomain code of the error'''
+        return self._code
+
+    def localizedDescription(self):
+        '''Returns a description of the error'''
+        return self.description
+
+    def userInfo(self):
+        '''There is no more to tell'''
+        return {}
+
+    def __str__(self):
+        return '%s %s' % (self._code, self.description)
+
+
+class ConnectionPool(object):
+    '''Idle keep-alive connections, by scheme, host and port, for HTTPGurls
+    to reuse'''
+
+    def __init__(self, maxidle=8):
+        self.maxidle = maxidle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, netloc, timeout):
+        '''Returns (connection, reused): an idle connection to netloc, or a
+        new one if there isn't one'''
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=timeout), False
+        if scheme == 'http':
+            return httplib.HTTPConnection(netloc, timeout=timeout), False
+        raise ValueError('unsupported URL scheme: %s' % scheme)
+
+    def put(self, scheme, netloc, connection):
+        '''Keeps connection around for the next request to netloc'''
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxidle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        '''Closes all the idle connections'''
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+g_pool = ConnectionPool()
+
+
+class HTTPGurl(GurlBase):
+    '''A class for getting content from a URL using httplib, with the same
+    options and attributes as a Gurl. The request runs on a thread of its
+    own, reusing keep-alive connections from g_pool.'''
+
+    # the most redirects we follow, like NSURLSession
+    MAX_REDIRECTS = 16
+    CHUNK_SIZE = 2**16
+
+    @classmethod
+    def alloc(cls):
+        '''So an HTTPGurl can be created just like a Gurl'''
+        return cls()
+
+    def initWithOptions_(self, options):
+        '''Set up our HTTPGurl object'''
+        self.setupWithOptions(options)
+        self.cancelled = False
+        self.connection = None
+        self.thread = None
+        return self
+
+    def start(self):
+        '''Start the request'''
+        if not self.destination_path:
+            self.log('No output file specified.')
+            self.finish()
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self):
+        '''Cancel the request'''
+        self.cancelled = True
+        connection = self.connection
+        if connection is not None and connection.sock is not None:
+            # wake the request thread if it is waiting for data
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.finish()
+
+    def isDone(self):
+        '''Check if the request is complete'''
+        return self.wait(.1)
+
+    def run(self):
+        '''Make the request and record how it went. Whatever goes wrong, the
+        request ends up done, so nobody waits for it forever.'''
+        try:
+            error = self.fetch()
+        except ValueError, err:
+            error = HTTPError(NSURLErrorUnsupportedURL, str(err))
+        except socket.timeout:
+            error = HTTPError(NSURLErrorTimedOut, 'The request timed out.')
+        except (socket.error, httplib.HTTPException), err:
+            if self.response is None:
+                error = HTTPError(NSURLErrorCannotConnectToHost,
+                                  'Could not connect to the server: %s'
+                                  % err)
+            else:
+                error = HTTPError(NSURLErrorNetworkConnectionLost,
+                                  'The network connection was lost: %s'
+                                  % err)
+        except Exception, err:
+            # e.g. an IOError opening or writing the destination file
+            error = HTTPError(NSURLErrorUnknown, str(err))
+        if self.cancelled:
+            error = HTTPError(NSURLErrorCancelled, 'cancelled')
+        if error:
+            self.error = error
+        try:
+            self.completeWithError(error)
+        except Exception, err:
+            # closing the destination file failed
+            if not self.error:
+                self.error = HTTPError(NSURLErrorUnknown, str(err))
+            self.finish()
+
+    def request(self, method, url, headers):
+        '''Sends a request for url and returns its response and the
+        connection it came in on'''
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            connection, reused = g_pool.get(
+                parsed.scheme, parsed.netloc, self.connection_timeout)
+            self.connection = connection
+            try:
+                connection.request(method, path, headers=headers)
+                return connection.getresponse(), connection
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if not reused or self.cancelled:
+                    raise
+                # the server closed the idle connection; try another one
+
+    def release(self, url, response, connection):
+        '''Reads what is left of response and gives connection back to the
+        pool if the server will keep it open'''
+        try:
+            response.read()
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            return
+        if response.will_close or self.cancelled:
+            connection.close()
+        else:
+            parsed = urlparse(url)
+            g_pool.put(parsed.scheme, parsed.netloc, connection)
+
+    def fetch(self):
+        '''Makes the request, following redirects and answering a
+        challenge for credentials, and writes what comes back. Returns an
+        HTTPError, or None.'''
+        headers = self.requestHeaders()
+        if (self.accept_encoding and not self.compression
+                and 'Range' not in headers):
+            headers['Accept-Encoding'] = ', '.join(ENCODINGS)
+        method = self.method or 'GET'
+        url = self.url
+        authorized = False
+        while True:
+            response, connection = self.request(method, url, headers)
+            if (response.status == 401 and self.username and self.password
+                    and not authorized):
+                self.log('Will attempt to authenticate.')
+                self.log('Username: %s Password: %s'
+                         % (self.username, ('*' * len(self.password or ''))))
+                self.release(url, response, connection)
+                headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                    '%s:%s' % (self.username, self.password))
+                authorized = True
+                continue
+            location = response.getheader('location')
+            if (response.status in (301, 302, 303, 307, 308) and location
+                    and len(self.redirection) < self.MAX_REDIRECTS):
+                newURL = urljoin(url, location)
+                self.redirection.append([newURL, dict(response.getheaders())])
+                if self.redirectAllowed(newURL):
+                    self.release(url, response, connection)
+                    if urlparse(newURL).netloc != urlparse(url).netloc:
+                        # credentials are only for the server that asked
+                        headers.pop('Authorization', None)
+                        authorized = False
+                    if response.status == 303 and method != 'HEAD':
+                        method = 'GET'
+                    url = newURL
+                    continue
+            break
+        return self.receiveResponse(url, response, connection)
+
+    def receiveResponse(self, url, response, connection):
+        '''Writes the body of response. Returns an HTTPError, or None.'''
+        self.response = response
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self.bytesReceived = 0
+        self.percentComplete = -1
+        try:
+            self.expectedLength = int(response.getheader('content-length'))
+        except (TypeError, ValueError):
+            self.expectedLength = UNKNOWN_LENGTH
+
+        download_data = {}
+        if 'last-modified' in self.headers:
+            download_data['last-modified'] = self.headers['last-modified']
+        if 'etag' in self.headers:
+            download_data['etag'] = self.headers['etag']
+        download_data['expected-length'] = self.expectedLength
+        self.content_encoding = self.headers.get('content-encoding')
+
+        if not self.openDestination(download_data):
+            # don't wait for a body we aren't going to use
+            connection.close()
+            return HTTPError(NSURLErrorCancelled, 'cancelled')
+        self.notifyProgress()
+
+        while not self.cancelled:
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            self.receiveData(chunk)
+        if response.length:
+            # the server went away before sending everything it said it
+            # would
+            connection.close()
+            return HTTPError(NSURLErrorNetworkConnectionLost,
+                             'The network connection was lost.')
+        self.release(url, response, connection)
+        return None
+
+
+TRANSPORTS = {'http': HTTPGurl}
+if FOUNDATION_AVAILABLE:
+    TRANSPORTS['foundation'] = Gurl
+    g_transport = 'foundation'
+else:
+    g_transport = 'http'
+
+
+def set_transport(name):
+    '''Picks the transport connection() uses: 'foundation' for Gurl, 'http'
+    for HTTPGurl. Raises ValueError if that transport isn't available.'''
+    # pylint: disable=W0603
+    global g_transport
+    if name not in TRANSPORTS:
+        raise ValueError('Transport %s is not available' % name)
+    g_transport = name
+
+
+def connection(options):
+    '''Returns a connection for options, made with the transport picked
+    with set_transport()'''
+    return TRANSPORTS[g_transport].alloc().initWithOptions_(options)
+
+
 if __name__ == '__main__':
     print 'This is a library of support tools for the Munki Suite.'
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2018 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ialog.py
+
+Buffered logging for InstallApplications. Messages are queued and written
+by a background thread in batches, so logging never blocks a download or an
+install. Where they end up is decided by pluggable backends:
+
+    logger = Logger([NSLogBackend(), FileBackend('/var/log/ia.log')])
+    logger.log('[InstallApplications] Beginning userland')
+
+The queue is bounded unless maxqueue is None. Messages logged with a coalesce
+key replace a queued message with the same key, so only the latest progress
+line of a chatty installer is written if the writer falls behind. Once a
+bounded queue is full new messages are dropped and counted, and the count is
+logged when there is room again. Logs that are read as commands, like
+DEPNotify's, should be unbounded so nothing is dropped or added to them.
+"""
+
+import atexit
+import collections
+import json
+import sys
+import threading
+import time
+
+
+class NSLogBackend(object):
+    '''Writes messages to the system log'''
+
+    def __init__(self):
+        # Imported here so the other backends work without PyObjC.
+        from Foundation import NSLog
+        self.nslog = NSLog
+
+    def write(self, records):
+        for timestamp, text in records:
+            # Pass the text as an argument so NSLog doesn't treat any %
+            # in it as a format specifier.
+            self.nslog('%@', text)
+
+    def close(self):
+        pass
+
+
+class FileBackend(object):
+    '''Appends messages to a file, which is kept open between batches. With
+    timestamps, each line is prefixed with the time it was logged.'''
+
+    def __init__(self, path, timestamps=True):
+        self.path = path
+        self.timestamps = timestamps
+        self.file = None
+
+    def open(self):
+        return open(self.path, 'a')
+
+    def format(self, timestamp, text):
+        if not self.timestamps:
+            return text + '\n'
+        return '%s %s\n' % (time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), text)
+
+    def write(self, records):
+        if self.file is None:
+            self.file = self.open()
+        self.file.write(''.join(self.format(timestamp, text)
+                                for timestamp, text in records))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StderrBackend(FileBackend):
+    '''Writes messages to stderr'''
+
+    def __init__(self, timestamps=True):
+        FileBackend.__init__(self, None, timestamps)
+
+    def open(self):
+        return sys.stderr
+
+    def close(self):
+        self.file = None
+
+
+class JSONLinesBackend(FileBackend):
+    '''Appends each message to a file as a JSON object on its own line'''
+
+    def __init__(self, path):
+        FileBackend.__init__(self, path)
+
+    def format(self, timestamp, text):
+        return json.dumps({'time': timestamp, 'message': text}) + '\n'
+
+
+def backend(spec):
+    '''Returns the backend described by spec: nslog, stderr, file:<path> or
+    jsonl:<path>. Raises ValueError for anything else.'''
+    kind, sep, path = spec.partition(':')
+    if kind == 'nslog' and not sep:
+        return NSLogBackend()
+    if kind == 'stderr' and not sep:
+        return StderrBackend()
+    if kind == 'file' and path:
+        return FileBackend(path)
+    if kind == 'jsonl' and path:
+        return JSONLinesBackend(path)
+    raise ValueError('Unknown log backend: %s' % spec)
+
+
+class Logger(object):
+    '''Queues messages and writes them to its backends on a background
+    thread. With maxqueue None the queue is unbounded and no message is ever
+    dropped.'''
+
+    def __init__(self, backends, maxqueue=10000, interval=0.2):
+        self.backends = list(backends)
+        self.maxqueue = maxqueue
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        # coalesce key -> index of its message in the current queue
+        self.pending = {}
+        self.dropped = 0
+        self.writing = False
+        self.closed = False
+        self.thread = None
+        atexit.register(self.close)
+
+    def configure(self, backends):
+        '''Replaces the backends once everything queued so far is written'''
+        self.flush()
+        with self.cond:
+            old, self.backends = self.backends, list(backends)
+        for item in old:
+            item.close()
+
+    def log(self, text, coalesce=None):
+        '''Queues text. If coalesce is set and a message with the same key is
+        still queued, that message is replaced instead.'''
+        with self.cond:
+            if self.closed:
+                return
+            if coalesce is not None and coalesce in self.pending:
+                index = self.pending[coalesce]
+                self.queue[index] = (time.time(), text)
+                return
+            if (self.maxqueue is not None
+                    and len(self.queue) >= self.maxqueue):
+                self.dropped += 1
+                return
+            if coalesce is not None:
+                self.pending[coalesce] = len(self.queue)
+            self.queue.append((time.time(), text))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.dropped:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                records = list(self.queue)
+                self.queue.clear()
+                self.pending.clear()
+                if self.dropped:
+                    records.append((time.time(), 'Log queue full: dropped %d '
+                                    'messages' % self.dropped))
+                    self.dropped = 0
+                backends = self.backends
+                self.writing = True
+            for item in backends:
+                try:
+                    item.write(records)
+                except Exception:
+                    # There is nowhere left to report this.
+                    pass
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+            # Let a few more messages pile up so they are written together.
+            time.sleep(self.interval)
+
+    def flush(self, timeout=5):
+        '''Waits up to timeout seconds for everything queued to be
+        written'''
+        deadline = time.time() + timeout
+        with self.cond:
+            self.cond.notify_all()
+            while (self.queue or self.writing) and self.thread is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+    def close(self):
+        '''Writes everything that is queued and closes the backends'''
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            backends = self.backends
+        for item in backends:
+            item.close()
@@ -26,35 +26,112 @@
 # Notice a pattern?
 
 from distutils.version import LooseVersion
-from Foundation import NSLog
+from Foundation import NSDictionary
 from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+import collections
 import hashlib
 import json
 import optparse
 import os
 import plistlib
+import random
 import re
 import shutil
+import socket
 import subprocess
 import sys
+import threading
 import time
 import urllib
 sys.path.append('/usr/local/installapplications')
 # PEP8 can really be annoying at times.
+import agentipc  # noqa
+import consolewatcher  # noqa
 import gurl  # noqa
+import ialog  # noqa
 
 
 g_dry_run = False
 
+DEPNOTIFY_LOG = '/private/var/tmp/depnotify.log'
+
+# Log messages are written on background threads so logging never holds up
+# a download or an install. DEPNotify reads its log as it is written, so its
+# messages are never coalesced, reordered or dropped.
+g_log = ialog.Logger([ialog.NSLogBackend()])
+g_deplog = ialog.Logger([ialog.FileBackend(DEPNOTIFY_LOG, timestamps=False)],
+                        maxqueue=None)
+
+# The daemon's connection to the LaunchAgent that runs user scripts. None
+# until the first user script, False if we couldn't listen for it.
+AGENT_SOCKET_PATH = '/var/run/installapplications/userscript.sock'
+g_agent = None
+
+# Wakes up waiters as soon as the console user changes. Created on first use.
+g_consolewatcher = None
+g_consolewatcher_lock = threading.Lock()
+
+INSTALLER = '/usr/sbin/installer'
+
+# The phases of an item recorded in the run report, in order.
+REPORT_PHASES = ['queued', 'started', 'download_start', 'first_byte',
+                 'download_end', 'verified', 'install_start', 'done']
+
+# DEPNotify progress bar steps for each download or install status message.
+DEPNOTIFY_STEPS = 100
+
+# Files smaller than this are always downloaded as a single stream.
+SEGMENTED_DOWNLOAD_MINIMUM = 64 * 1024 * 1024
+
+# sha256 digests of files we have already read, keyed by path, inode, size and
+# mtime so a file is only hashed again if it changes on disk. Least recently
+# used entries are evicted first.
+HASH_CACHE_SIZE = 256
+g_hash_cache = collections.OrderedDict()
+g_hash_cache_lock = threading.Lock()
+
+# Installed package receipts, loaded once per run by loadreceipts() and kept
+# up to date as we install packages.
+RECEIPTS_PATH = '/private/var/db/receipts'
+g_receipts = None
+g_receipts_lock = threading.Lock()
+
+# Serializes changes to the download cache at --cache-path.
+g_cache_lock = threading.Lock()
+
+# Only one process can use /usr/sbin/installer at a time, and the LaunchAgent
+# only runs one user script at a time.
+g_installer_lock = threading.Lock()
+g_userscript_lock = threading.Lock()
+
+# Root scripts marked parallel that are still running in the current stage.
+g_parallel_scripts = []
+g_parallel_scripts_lock = threading.Lock()
+
 
 def deplog(text):
-    depnotify = '/private/var/tmp/depnotify.log'
-    with open(depnotify, 'a+') as log:
-        log.write(text + '\n')
+    g_deplog.log(text)
+
 
+def depstatus(text, steps=None):
+    '''Shows text as the DEPNotify status and moves the progress bar by steps,
+    one full item by default'''
+    if steps is None:
+        steps = DEPNOTIFY_STEPS
+    deplog('Status: ' + text)
+    if steps:
+        deplog('Command: DeterminateManualStep: %d' % steps)
 
-def iaslog(text):
-    NSLog('[InstallApplications] ' + text)
+
+def iaslog(text, coalesce=None):
+    g_log.log('[InstallApplications] ' + text, coalesce)
+
+
+def flushlogs():
+    '''Waits for queued log messages to be written, for when the process is
+    about to be killed'''
+    g_log.flush()
+    g_deplog.flush()
 
 
 def getconsoleuser():
@@ -62,6 +139,19 @@ def getconsoleuser():
     return cfuser
 
 
+def waitforusersession(message):
+    '''Blocks until a user has logged in, logging message once if we have to
+    wait'''
+    global g_consolewatcher
+    with g_consolewatcher_lock:
+        if g_consolewatcher is None:
+            g_consolewatcher = consolewatcher.ConsoleUserWatcher()
+    if not g_consolewatcher.insession():
+        iaslog(message)
+        user = g_consolewatcher.waitforsession()
+        iaslog('User session started for %s' % user[0])
+
+
 def pkgregex(pkgpath):
     try:
         # capture everything after last / in the pkg filepath
@@ -71,31 +161,132 @@ def pkgregex(pkgpath):
         return packagepath
 
 
-def installpackage(packagepath):
+def installpackage(packagepath, progress=None):
+    '''Installs the package at packagepath and returns installer's exit code.
+    If given, progress is called with (percent, phase) as installer reports
+    them; either may be None.'''
     try:
-        cmd = ['/usr/sbin/installer', '-verboseR', '-pkg', packagepath,
-               '-target', '/']
+        cmd = [INSTALLER, '-verboseR', '-pkg', packagepath, '-target', '/']
         if g_dry_run:
             iaslog('Dry run installing package: %s' % packagepath)
             return 0
-        proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output, rcode = proc.communicate(), proc.returncode
-        installlog = output[0].split('\n')
-        # Filter all blank lines after the split.
-        for line in filter(None, installlog):
-            # Replace any instances of % with a space and any elipsis with
-            # a blank line since NSLog can't handle these kinds of characters.
-            # Hopefully this is the only bad characters we will ever run into.
-            logline = line.replace('%', ' ').replace('\xe2\x80\xa6', '')
-            iaslog(logline)
+        with g_installer_lock:
+            proc = subprocess.Popen(cmd, shell=False, bufsize=1,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            proc.stdin.close()
+            # Log the output as it arrives instead of holding all of it in
+            # memory until the install is done. Iterating over the file
+            # itself would read ahead and delay the progress updates.
+            for line in iter(proc.stdout.readline, ''):
+                line = line.rstrip('\n')
+                # Filter all blank lines.
+                if not line:
+                    continue
+                # Replace any instances of % with a space and any elipsis
+                # with a blank line since NSLog can't handle these kinds of
+                # characters. Hopefully this is the only bad characters we
+                # will ever run into.
+                logline = line.replace('%', ' ').replace('\xe2\x80\xa6', '')
+                event = parseinstallerline(line)
+                if event and event[0] is not None:
+                    # Only the latest percentage is worth logging if the
+                    # installer is ahead of the log.
+                    iaslog(logline, coalesce='installer-progress')
+                else:
+                    iaslog(logline)
+                if progress and event:
+                    progress(*event)
+            rcode = proc.wait()
         return rcode
     except Exception:
         pass
 
 
+def parseinstallerline(line):
+    '''Returns (percent, phase) for a progress line of installer -verboseR
+    output, or None for any other line'''
+    if line.startswith('installer:%'):
+        try:
+            return (float(line[len('installer:%'):]), None)
+        except ValueError:
+            return None
+    if line.startswith('installer:PHASE:'):
+        phase = line[len('installer:PHASE:'):].replace('\xe2\x80\xa6', '')
+        return (None, phase.strip())
+    return None
+
+
+class InstallProgress(object):
+    '''Moves the DEPNotify progress bar along with installer's progress while
+    a package installs'''
+
+    def __init__(self, name, steps=DEPNOTIFY_STEPS):
+        self.name = name
+        self.steps = steps
+        self.sent = 0
+        self.phase = None
+
+    def update(self, percent, phase):
+        if phase and phase != self.phase:
+            self.phase = phase
+            deplog('Status: Installing: %s - %s' % (self.name, phase))
+        if percent is not None:
+            # Only whole steps are sent, so a chatty installer can't flood
+            # the DEPNotify log.
+            target = min(self.steps, int(percent * self.steps / 100))
+            if target > self.sent:
+                deplog('Command: DeterminateManualStep: %d' % (
+                    target - self.sent))
+                self.sent = target
+
+    def finish(self):
+        '''Fills in whatever installer didn't report'''
+        self.update(100, None)
+
+
+def loadreceipts():
+    '''Takes a snapshot of the receipts database so we don't have to spawn
+    pkgutil for every package. Falls back to pkgutil if the database can't be
+    read.'''
+    global g_receipts
+    receipts = {}
+    try:
+        filenames = os.listdir(RECEIPTS_PATH)
+    except OSError as err:
+        iaslog('Could not read receipts database: %s' % str(err))
+        receipts = None
+    else:
+        for filename in filenames:
+            if not filename.endswith('.plist'):
+                continue
+            plist = NSDictionary.dictionaryWithContentsOfFile_(
+                os.path.join(RECEIPTS_PATH, filename))
+            if plist and plist.get('PackageIdentifier'):
+                receipts[plist['PackageIdentifier']] = plist.get(
+                    'PackageVersion', '0.0.0.0.0')
+        iaslog('Loaded %d package receipts' % len(receipts))
+    with g_receipts_lock:
+        g_receipts = receipts
+
+
+def recordreceipt(packageid, version):
+    '''Updates the receipt snapshot after a successful install'''
+    with g_receipts_lock:
+        if g_receipts is not None:
+            g_receipts[packageid] = version
+
+
 def checkreceipt(packageid):
+    with g_receipts_lock:
+        receipts = g_receipts
+    if receipts is not None:
+        return receipts.get(packageid, '0.0.0.0.0')
+    return pkgutilreceipt(packageid)
+
+
+def pkgutilreceipt(packageid):
     try:
         cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', packageid]
         proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
@@ -113,11 +304,45 @@ def checkreceipt(packageid):
         return version
 
 
+def hashcachekey(filename):
+    '''Returns the stat identity of filename used to key g_hash_cache'''
+    st = os.stat(filename)
+    return (filename, st.st_ino, st.st_size,
+            getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)))
+
+
+def cachehash(filename, digest, key=None):
+    '''Records the sha256 digest of filename in g_hash_cache'''
+    if key is None:
+        key = hashcachekey(filename)
+    with g_hash_cache_lock:
+        g_hash_cache.pop(key, None)
+        g_hash_cache[key] = digest
+        while len(g_hash_cache) > HASH_CACHE_SIZE:
+            g_hash_cache.popitem(last=False)
+
+
+def forgethash(filename):
+    '''Drops the digests g_hash_cache has for filename, for when it was
+    changed in place faster than its mtime can show'''
+    with g_hash_cache_lock:
+        for key in [key for key in g_hash_cache if key[0] == filename]:
+            del g_hash_cache[key]
+
+
 def gethash(filename):
-    hash_function = hashlib.sha256()
     if not os.path.isfile(filename):
         return 'NOT A FILE'
 
+    key = hashcachekey(filename)
+    with g_hash_cache_lock:
+        if key in g_hash_cache:
+            # Move it to the end so it is evicted last.
+            digest = g_hash_cache.pop(key)
+            g_hash_cache[key] = digest
+            return digest
+
+    hash_function = hashlib.sha256()
     fileref = open(filename, 'rb')
     while 1:
         chunk = fileref.read(2**16)
@@ -125,7 +350,9 @@ def gethash(filename):
             break
         hash_function.update(chunk)
     fileref.close()
-    return hash_function.hexdigest()
+    digest = hash_function.hexdigest()
+    cachehash(filename, digest, key)
+    return digest
 
 
 def launchctl(*arg):
@@ -136,8 +363,62 @@ def launchctl(*arg):
     return output
 
 
+def marktime(item, phase):
+    '''Records when item first reached phase, for the run report'''
+    item.setdefault('timing', {}).setdefault(phase, time.time())
+
+
+def recordtransfer(item, connection):
+    '''Adds what connection downloaded for item to its timing'''
+    timing = item.setdefault('timing', {})
+    timing['bytes'] = timing.get('bytes', 0) + connection.bytes_transferred
+    if connection.first_byte_time is not None:
+        timing['first_byte'] = min(timing.get('first_byte', time.time()),
+                                   connection.first_byte_time)
+
+
+def writereport(reportpath, iajson, started):
+    '''Writes how long each item spent in each phase to reportpath as
+    JSON'''
+    items = []
+    for stage in ['preflight', 'setupassistant', 'userland']:
+        for item in iajson.get(stage, []):
+            timing = item.get('timing', {})
+            entry = {'stage': stage, 'name': item.get('name'),
+                     'type': item.get('type'),
+                     'source': timing.get('source'),
+                     'bytes': timing.get('bytes', 0),
+                     'phases': dict((phase, timing[phase])
+                                    for phase in REPORT_PHASES
+                                    if phase in timing)}
+            if 'download_start' in timing and 'download_end' in timing:
+                seconds = timing['download_end'] - timing['download_start']
+                entry['download_seconds'] = seconds
+                if seconds > 0:
+                    entry['bytes_per_second'] = entry['bytes'] / seconds
+            if 'install_start' in timing and 'done' in timing:
+                entry['install_seconds'] = (timing['done'] -
+                                            timing['install_start'])
+            if 'started' in timing and 'done' in timing:
+                entry['total_seconds'] = timing['done'] - timing['started']
+            items.append(entry)
+    finished = time.time()
+    report = {'started': started, 'finished': finished,
+              'total_seconds': finished - started, 'items': items}
+    try:
+        if not os.path.isdir(os.path.dirname(reportpath)):
+            os.makedirs(os.path.dirname(reportpath))
+        with open(reportpath + '.tmp', 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.rename(reportpath + '.tmp', reportpath)
+        iaslog('Wrote run report to %s' % reportpath)
+    except (IOError, OSError) as err:
+        iaslog('Could not write run report to %s: %s' % (reportpath,
+                                                          str(err)))
+
+
 def downloadfile(options):
-    connection = gurl.Gurl.alloc().initWithOptions_(options)
+    connection = gurl.connection(options)
     percent_complete = -1
     bytes_received = 0
     connection.start()
@@ -149,7 +430,8 @@ def downloadfile(options):
         sys.exit(1)
 
     try:
-        while not connection.isDone():
+        # Wake up on progress or completion rather than on a timer.
+        while not connection.wait():
             if connection.destination_path:
                 # only print progress info if we are writing to a file
                 if connection.percentComplete != -1:
@@ -182,6 +464,220 @@ def downloadfile(options):
         iaslog('Headers: %s ' % (str(connection.headers)))
     if connection.redirection != []:
         iaslog('Redirection: %s ' % (str(connection.redirection)))
+    return connection
+
+
+def downloadsegmented(options, segments):
+    '''Downloads options['url'] as several byte ranges at once, each written
+    into its place in a preallocated options['file']. Returns False if the
+    file is too small to bother, the server doesn't support byte ranges or a
+    segment failed. Segments that finished are remembered in
+    options['segments'], which is left set after a failed segment so the
+    next attempt only downloads the rest; without it the caller should fall
+    back to a single stream.'''
+    if segments < 2 or options.get('compression'):
+        # Ranges of a compressed file can't be decompressed on their own.
+        return False
+    path = options['file']
+    probe = dict(options)
+    probe.update({'method': 'HEAD', 'can_resume': False,
+                  'download_only_if_changed': False})
+    for key in ('hash_algorithm', 'expected_hash'):
+        probe.pop(key, None)
+    connection = gurl.connection(probe)
+    connection.start()
+    while not connection.wait():
+        pass
+    if (connection.error is not None
+            or not str(connection.status).startswith('2')):
+        return False
+    headers = connection.normalize_header_dict(connection.headers or {})
+    if headers.get('accept-ranges', '').lower() != 'bytes':
+        iaslog('Server does not support byte ranges for %s' % options['name'])
+        return False
+    try:
+        length = int(headers.get('content-length'))
+    except (TypeError, ValueError):
+        return False
+    if length < SEGMENTED_DOWNLOAD_MINIMUM:
+        return False
+
+    # Pick up where an earlier attempt left off if it was downloading the
+    # same file from the server.
+    state = options.get('segments')
+    validators = (length, headers.get('etag'), headers.get('last-modified'))
+    if (state and state['validators'] == validators
+            and os.path.isfile(path) and os.path.getsize(path) == length):
+        iaslog('Resuming segmented download of %s, %d of %d segments done'
+               % (options['name'], len(state['done']), len(state['ranges'])))
+    else:
+        # Start from a fresh, preallocated file so no stale resume data is
+        # left on it.
+        if os.path.isfile(path):
+            os.remove(path)
+        with open(path, 'wb') as destination:
+            destination.truncate(length)
+        size = length // segments
+        ranges = []
+        for index in range(segments):
+            start = index * size
+            if index == segments - 1:
+                end = length - 1
+            else:
+                end = start + size - 1
+            ranges.append((start, end))
+        state = {'validators': validators, 'ranges': ranges, 'done': []}
+        options['segments'] = state
+        iaslog('Downloading %s in %d segments of %s bytes' % (
+               options['name'], segments, size))
+
+    def startsegment(byte_range):
+        segment = dict(probe)
+        segment.update({'method': None, 'byte_range': byte_range})
+        connection = gurl.connection(segment)
+        connection.start()
+        return connection
+
+    def segmentok(connection):
+        start, end = connection.byte_range
+        return (connection.error is None and connection.status == 206
+                and connection.bytesReceived == end - start + 1)
+
+    connections = [startsegment(r) for r in state['ranges']
+                   if list(r) not in state['done']]
+    # what the segments finished on earlier attempts add up to
+    finished = sum(end - start + 1 for start, end in state['done'])
+    percent_complete = -1
+    retries = {}
+    try:
+        while True:
+            pending = [c for c in connections if not c.done]
+            if not pending:
+                failed = []
+                for connection in connections:
+                    if not segmentok(connection):
+                        failed.append(connection)
+                    elif list(connection.byte_range) not in state['done']:
+                        state['done'].append(list(connection.byte_range))
+                if not failed:
+                    break
+                for connection in failed:
+                    if connection.range_unsupported:
+                        options.pop('segments', None)
+                        return False
+                    byte_range = tuple(connection.byte_range)
+                    retries[byte_range] = retries.get(byte_range, 0) + 1
+                    if retries[byte_range] > 2:
+                        iaslog('Segment %s-%s of %s failed' % (
+                               byte_range[0], byte_range[1],
+                               options['name']))
+                        return False
+                    connections[connections.index(connection)] = \
+                        startsegment(byte_range)
+                continue
+            pending[0].wait(1)
+            received = finished + sum(c.bytesReceived for c in connections)
+            percent = int(float(received) / float(length) * 100.0)
+            if percent != percent_complete:
+                percent_complete = percent
+                iaslog('Downloading %s - Percent complete: %s ' % (
+                       options['name'], percent_complete))
+    except (KeyboardInterrupt, SystemExit):
+        for connection in connections:
+            connection.cancel()
+        raise
+    for connection in connections:
+        recordtransfer(options, connection)
+    options.pop('segments', None)
+    return True
+
+
+def downloadhash(connection, path):
+    '''Returns the hash Gurl computed while writing path, falling back to
+    reading the file back from disk if nothing was written.'''
+    if connection.digest is not None and os.path.isfile(path):
+        # Remember it so later checks of this file don't read it again.
+        cachehash(path, connection.digest)
+        return connection.digest
+    return gethash(path)
+
+
+def verifychunks(path, chunksize, chunkhashes, indexes=None):
+    '''Returns the indexes of the chunks of path that don't match their
+    sha256 in chunkhashes. Only the chunks in indexes are read, if given.'''
+    if indexes is None:
+        indexes = range(len(chunkhashes))
+    bad = []
+    with open(path, 'rb') as fileref:
+        for index in indexes:
+            fileref.seek(index * chunksize)
+            hash_function = hashlib.sha256()
+            remaining = chunksize
+            while remaining:
+                chunk = fileref.read(min(2**16, remaining))
+                if not chunk:
+                    break
+                hash_function.update(chunk)
+                remaining -= len(chunk)
+            if hash_function.hexdigest() != chunkhashes[index].lower():
+                bad.append(index)
+    return bad
+
+
+def repairchunks(item, connection):
+    '''Downloads again just the chunks of a finished download that don't
+    match the item's chunk_hashes, with byte range requests. connection is
+    the download that just finished, or None if it was segmented. Returns
+    True if every chunk matches afterwards, leaving only the whole file hash
+    to check.'''
+    path = item['file']
+    chunksize = item.get('chunk_size')
+    chunkhashes = item.get('chunk_hashes')
+    if (not chunksize or not chunkhashes or item.get('compression')
+            or not os.path.isfile(path)):
+        return False
+    size = os.path.getsize(path)
+    if not (len(chunkhashes) - 1) * chunksize < size <= \
+            len(chunkhashes) * chunksize:
+        # Not the file the chunk hashes are for, so there is nothing to
+        # repair.
+        return False
+    if connection is not None and connection.bad_chunks is not None:
+        # gurl checked them while it wrote the file.
+        bad = connection.bad_chunks
+    else:
+        bad = verifychunks(path, chunksize, chunkhashes)
+    if not bad or len(bad) == len(chunkhashes):
+        return False
+    iaslog('Downloading %d of %d chunks of %s again' % (
+           len(bad), len(chunkhashes), item['name']))
+    options = dict(item)
+    for key in ('hash_algorithm', 'expected_hash', 'chunk_size',
+                'chunk_hashes'):
+        options.pop(key, None)
+    options.update({'method': None, 'can_resume': False,
+                    'download_only_if_changed': False})
+    for index in bad:
+        start = index * chunksize
+        end = min(start + chunksize, size) - 1
+        options['byte_range'] = (start, end)
+        connection = gurl.connection(options)
+        connection.start()
+        while not connection.wait():
+            pass
+        recordtransfer(item, connection)
+        if (connection.error is not None or connection.status != 206
+                or connection.bytesReceived != end - start + 1):
+            iaslog('Could not download chunk %d of %s' % (index,
+                                                           item['name']))
+            return False
+    forgethash(path)
+    still = verifychunks(path, chunksize, chunkhashes, bad)
+    if still:
+        iaslog('Chunks %s of %s are still bad' % (
+               ', '.join(str(index) for index in still), item['name']))
+        return False
+    return True
 
 
 def vararg_callback(option, opt_str, value, parser):
@@ -207,7 +703,7 @@ def vararg_callback(option, opt_str, value, parser):
     setattr(parser.values, option.dest, value)
 
 
-def runrootscript(pathname, donotwait):
+def runrootscript(pathname, donotwait, parallel=False):
     '''Runs script located at given pathname'''
     if g_dry_run:
         iaslog('Dry run executing root script: %s' % pathname)
@@ -217,6 +713,11 @@ def runrootscript(pathname, donotwait):
             iaslog('Do not wait triggered')
             proc = subprocess.Popen(pathname)
             iaslog('Running Script: %s ' % (str(pathname)))
+        elif parallel:
+            proc = subprocess.Popen(pathname, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            iaslog('Running Script in parallel: %s ' % (str(pathname)))
+            trackparallelscript(pathname, proc)
         else:
             proc = subprocess.Popen(pathname, stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE)
@@ -234,75 +735,394 @@ def runrootscript(pathname, donotwait):
     return True
 
 
-def runuserscript(iauserscriptpath):
-    files = os.listdir(iauserscriptpath)
-    for file in files:
-        pathname = os.path.join(iauserscriptpath, file)
-        if g_dry_run:
-            iaslog('Dry run executing user script: %s' % pathname)
-            os.remove(pathname)
-            return True
-        try:
-            proc = subprocess.Popen(pathname, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            iaslog('Running Script: %s ' % (str(pathname)))
-            (out, err) = proc.communicate()
-            if err and proc.returncode == 0:
-                iaslog(
-                    'Output from %s on stderr but ran successfully: %s' %
-                    (pathname, err))
-            elif proc.returncode > 0:
-                iaslog('Failure running script: ' + str(err))
-                return False
-        except OSError as err:
+def trackparallelscript(pathname, proc):
+    '''Collects the output of a script started by runrootscript in the
+    background, so that waitforparallelscripts can report it'''
+    output = {}
+
+    def communicate():
+        output['out'], output['err'] = proc.communicate()
+
+    thread = threading.Thread(target=communicate)
+    thread.daemon = True
+    thread.start()
+    with g_parallel_scripts_lock:
+        g_parallel_scripts.append((pathname, proc, thread, output))
+
+
+def waitforparallelscripts(pathnames=None):
+    '''Waits for all scripts started in parallel, or only the ones at
+    pathnames, to finish and reports their results. Returns the paths of the
+    scripts that failed.'''
+    with g_parallel_scripts_lock:
+        scripts = [x for x in g_parallel_scripts
+                   if pathnames is None or x[0] in pathnames]
+        g_parallel_scripts[:] = [x for x in g_parallel_scripts
+                                 if x not in scripts]
+    failed = []
+    for pathname, proc, thread, output in scripts:
+        iaslog('Waiting for parallel script to complete: %s' % pathname)
+        # join() without a timeout can't be interrupted in Python 2
+        while thread.is_alive():
+            thread.join(1)
+        # Judged like a script run in the foreground by runrootscript.
+        if proc.returncode > 0:
+            iaslog('Parallel script %s received non-zero exit code %d: %s' % (
+                   pathname, proc.returncode, str(output.get('err'))))
+            failed.append(pathname)
+        elif output.get('err'):
+            iaslog('Output from %s on stderr but ran successfully: %s' %
+                   (pathname, output['err']))
+    if failed:
+        iaslog('%d of %d parallel scripts failed: %s' % (
+               len(failed), len(scripts), ', '.join(failed)))
+    return failed
+
+
+def runuserscriptfile(pathname):
+    '''Runs the user script at pathname and removes it if it succeeded.
+    Returns its exit code and output.'''
+    if g_dry_run:
+        iaslog('Dry run executing user script: %s' % pathname)
+        os.remove(pathname)
+        return 0, ''
+    try:
+        proc = subprocess.Popen(pathname, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        iaslog('Running Script: %s ' % (str(pathname)))
+        (out, err) = proc.communicate()
+        if err and proc.returncode == 0:
+            iaslog(
+                'Output from %s on stderr but ran successfully: %s' %
+                (pathname, err))
+        elif proc.returncode > 0:
             iaslog('Failure running script: ' + str(err))
+            return proc.returncode, out + err
+    except OSError as err:
+        iaslog('Failure running script: ' + str(err))
+        return 1, str(err)
+    os.remove(pathname)
+    return proc.returncode, out + err
+
+
+def runuserscript(iauserscriptpath, userscripttouchpath):
+    '''Runs the user script the daemon named in the touch file, or the first
+    one in iauserscriptpath if it didn't name one'''
+    try:
+        with open(userscripttouchpath) as touchfile:
+            pathname = touchfile.read().strip()
+    except IOError:
+        pathname = ''
+    if pathname:
+        if os.path.dirname(pathname) != iauserscriptpath:
+            iaslog('Not running %s, which is not a user script' % pathname)
             return False
-        os.remove(pathname)
-        return True
+        files = [os.path.basename(pathname)]
+    else:
+        files = os.listdir(iauserscriptpath)
+    for file in files:
+        pathname = os.path.join(iauserscriptpath, file)
+        returncode, output = runuserscriptfile(pathname)
+        return returncode <= 0
     else:
         iaslog('No user scripts found!')
         return False
 
 
-def download_if_needed(item, stage, type, opts, depnotifystatus):
-    # Check if the file exists and matches the expected hash.
+def triggeruserscript(pathname, userscripttouchpath):
+    '''Has the LaunchAgent run the user script at pathname and waits for it
+    to finish'''
+    global g_agent
+    uid = getconsoleuser()[1]
+    if g_agent and not g_agent.connection and g_agent.uid != uid:
+        # The console user changed, so listen for their agent instead.
+        g_agent.close()
+        g_agent = None
+    if g_agent is None:
+        try:
+            g_agent = agentipc.AgentServer(AGENT_SOCKET_PATH, uid)
+        except (socket.error, OSError) as err:
+            iaslog('Could not listen for the LaunchAgent on %s: %s' % (
+                   AGENT_SOCKET_PATH, str(err)))
+            g_agent = False
+    # launchd starts the LaunchAgent while the touch file exists. It names
+    # the script in case the agent can't reach us and runs it on its own.
+    writetouchfile(userscripttouchpath, pathname)
+    if g_agent:
+        # If the agent goes away, give a fresh one a second try before
+        # going back to the touch file.
+        for attempt in range(2):
+            if not g_agent.connection:
+                iaslog('Waiting for the LaunchAgent to connect')
+            while not g_agent.accept(0.5):
+                if not os.path.isfile(userscripttouchpath):
+                    # It didn't connect and ran the script on its own.
+                    return
+            result = g_agent.run(pathname)
+            if result is not None:
+                break
+            iaslog('LaunchAgent went away while running %s' % pathname)
+            writetouchfile(userscripttouchpath, pathname)
+        else:
+            iaslog('Running %s through the touch file instead' % pathname)
+            g_agent.close()
+            g_agent = False
+            writetouchfile(userscripttouchpath, pathname)
+        if g_agent:
+            if result[0] > 0:
+                iaslog('User script %s failed with exit code %d: %s' % (
+                       pathname, result[0], result[1]))
+            else:
+                iaslog('User script %s completed' % pathname)
+            return
+    while os.path.isfile(userscripttouchpath):
+        iaslog('Waiting for user script to complete: %s' % (pathname))
+        time.sleep(0.5)
+
+
+def stopuseragent(userscripttouchpath):
+    '''Tells a LaunchAgent that is waiting for user scripts to quit'''
+    global g_agent
+    if g_agent:
+        # Remove the touch file first, or launchd starts the agent again.
+        if os.path.isfile(userscripttouchpath):
+            os.remove(userscripttouchpath)
+        g_agent.close()
+    g_agent = None
+
+
+class RetryPolicy(object):
+    '''How many times to retry a failed download and how long to wait before
+    each retry: exponential backoff with full jitter, capped at maxbackoff
+    seconds.'''
+
+    def __init__(self, attempts=3, backoff=1.0, maxbackoff=60.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+
+    def delay(self, attempt):
+        '''Returns the number of seconds to wait before retry number
+        attempt, counting from 1.'''
+        ceiling = min(self.maxbackoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+def interrupted(connection):
+    '''Returns True if a download stopped because of the network or the
+    server rather than because we received the wrong content.'''
+    if connection.content_changed:
+        return False
+    if connection.error is not None:
+        return True
+    status = connection.status
+    return (status is not None and status != 416
+            and not str(status).startswith('2'))
+
+
+def cacheentrypath(cachepath, hash):
+    '''Returns where the download cache keeps the file with this hash'''
+    return os.path.join(cachepath, hash[:2], hash)
+
+
+def restorefromcache(path, hash, cachepath, link=True):
+    '''Links or copies the cached file with this hash to path. Returns True
+    if the cache had a good copy.'''
+    if not cachepath:
+        return False
+    entry = cacheentrypath(cachepath, hash)
+    with g_cache_lock:
+        if not os.path.isfile(entry):
+            return False
+        if gethash(entry) != hash:
+            iaslog('Removing corrupt download cache entry: %s' % entry)
+            os.remove(entry)
+            return False
+        # Mark it as recently used.
+        os.utime(entry, None)
+        if os.path.isfile(path):
+            os.remove(path)
+        if link:
+            try:
+                os.link(entry, path)
+            except OSError:
+                link = False
+        if not link:
+            shutil.copy2(entry, path)
+    return True
+
+
+def storeincache(path, hash, cachepath, cachesize, link=True):
+    '''Adds the verified file at path to the download cache, then evicts the
+    least recently used files until the cache fits in cachesize megabytes.'''
+    if not cachepath:
+        return
+    entry = cacheentrypath(cachepath, hash)
+    with g_cache_lock:
+        try:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            if not os.path.isfile(entry):
+                if link:
+                    try:
+                        os.link(path, entry)
+                    except OSError:
+                        link = False
+                if not link:
+                    shutil.copy2(path, entry)
+            os.utime(entry, None)
+            prunecache(cachepath, cachesize * 1024 * 1024)
+        except (IOError, OSError) as err:
+            iaslog('Could not add %s to the download cache: %s' % (
+                   path, str(err)))
+
+
+def prunecache(cachepath, maxbytes):
+    '''Removes the least recently used files from the download cache until
+    it holds no more than maxbytes.'''
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(cachepath):
+        for filename in filenames:
+            entry = os.path.join(dirpath, filename)
+            st = os.stat(entry)
+            entries.append((st.st_mtime, st.st_size, entry))
+            total += st.st_size
+    entries.sort()
+    while total > maxbytes and entries:
+        mtime, size, entry = entries.pop(0)
+        iaslog('Evicting %s from the download cache' % entry)
+        os.remove(entry)
+        total -= size
+
+
+def notifydownload(name, stage, opts, depnotifystatus):
+    '''Shows that name is downloading in DEPNotify and moves the progress bar
+    by its download step'''
+    if opts.depnotify:
+        if stage == 'setupassistant':
+            iaslog('Skipping DEPNotify notification due to setupassistant.')
+        else:
+            if depnotifystatus:
+                depstatus('Downloading %s' % (name))
+
+
+def downloaditem(item, stage, opts, depnotifystatus):
+    '''Downloads item until its hash is correct and returns the hash'''
     path = item['file']
     name = item['name']
     hash = item['hash']
     itemurl = item['url']
-    while not (os.path.isfile(path) and hash == gethash(path)):
-        # Check if additional headers are being passed and add
-        # them to the dictionary.
-        if opts.headers:
-            item.update({'additional_headers':
-                         {'Authorization': opts.headers}})
-        # Download the file once:
-        iaslog('Starting download: %s' % (urllib.unquote(itemurl.decode('utf8')
-                                                         )))
-        if opts.depnotify:
-            if stage == 'setupassistant':
-                iaslog('Skipping DEPNotify notification due to setupassistant.'
-                       )
-            else:
-                if depnotifystatus:
-                    deplog('Status: Downloading %s' % (name))
-        downloadfile(item)
-        # Wait half a second to process
-        time.sleep(0.5)
-        # Check the files hash and redownload until it's
-        # correct. Bail after three times and log event.
-        failsleft = 3
-        while not hash == gethash(path):
+    if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+        # Don't write through a hard link into the download cache.
+        os.remove(path)
+    # Check if additional headers are being passed and add
+    # them to the dictionary.
+    if opts.headers:
+        item.update({'additional_headers':
+                     {'Authorization': opts.headers}})
+    # Have gurl hash the file as it is written so we don't have to read
+    # it back from disk, and let it pick up an interrupted download where
+    # it left off.
+    item.update({'hash_algorithm': 'sha256', 'expected_hash': hash,
+                 'can_resume': True})
+    # Scripts are text, so have the server compress them if it can. The
+    # hash is always of the decompressed file.
+    if item.get('type') in ('rootscript', 'userscript'):
+        item['accept_encoding'] = True
+    if item.get('compression') and not gurl.decoder(item['compression']):
+        iaslog('Unsupported compression %s for %s: exiting!' % (
+               item['compression'], name))
+        sys.exit(1)
+    # Download the file once:
+    iaslog('Starting download: %s' % (urllib.unquote(itemurl.decode('utf8'))))
+    notifydownload(name, stage, opts, depnotifystatus)
+    # Check the files hash and redownload until it's correct, backing
+    # off between attempts. Bail once we run out of retries and log event.
+    policy = RetryPolicy(opts.download_retries, opts.retry_backoff)
+    attempt = 0
+    marktime(item, 'download_start')
+    item['timing']['source'] = 'network'
+    while True:
+        attempt += 1
+        connection = None
+        if downloadsegmented(item, opts.download_segments):
+            # Segments arrive out of order, so check the assembled file.
+            received = gethash(path)
+        elif item.get('segments'):
+            # A segment failed. The next attempt downloads only the
+            # segments that didn't finish.
+            received = None
+        else:
+            connection = downloadfile(item)
+            recordtransfer(item, connection)
+            received = downloadhash(connection, path)
+        if hash == received:
+            marktime(item, 'download_end')
+            break
+        if (received is not None
+                and (connection is None or not interrupted(connection))
+                and repairchunks(item, connection)):
+            # Only the bad chunks had to be downloaded again.
+            received = gethash(path)
+            if hash == received:
+                marktime(item, 'download_end')
+                break
+        if received is None:
+            iaslog('Segmented download of %s was interrupted after %d of '
+                   '%d segments' % (name, len(item['segments']['done']),
+                                    len(item['segments']['ranges'])))
+        elif connection is not None and interrupted(connection):
+            # Keep what we have so the next attempt can resume it.
+            iaslog('Download of %s was interrupted after %s bytes' % (
+                   name, connection.bytesReceived))
+        else:
+            # The content itself is wrong, so start over from zero.
             iaslog('Hash failed for %s - received: %s expected'
-                   ': %s' % (name, gethash(path), hash))
-            downloadfile(item)
-            failsleft -= 1
-            if failsleft == 0:
-                iaslog('Hash retry failed for %s: exiting!' % name)
-                sys.exit(1)
+                   ': %s' % (name, received, hash))
+            item.pop('segments', None)
+            if os.path.isfile(path):
+                os.remove(path)
+        if item.get('origin_url') and item['url'] != item['origin_url']:
+            # Don't let a broken cache proxy hold up the run.
+            iaslog('Cache proxy failed for %s, using %s instead' % (
+                   name, item['origin_url']))
+            item['url'] = item['origin_url']
+        if attempt > policy.attempts:
+            iaslog('Hash retry failed for %s: exiting!' % name)
+            sys.exit(1)
+        delay = policy.delay(attempt)
+        iaslog('Retrying download of %s in %.1f seconds (retry %d of %d)'
+               % (name, delay, attempt, policy.attempts))
+        time.sleep(delay)
+    return received
+
+
+def download_if_needed(item, stage, type, opts, depnotifystatus):
+    # Check if the file exists and matches the expected hash.
+    path = item['file']
+    name = item['name']
+    hash = item['hash']
+    if item.pop('prefetched', False):
+        # The Prefetcher downloaded it without telling DEPNotify, so count
+        # its download step now that it is this item's turn.
+        notifydownload(name, stage, opts, depnotifystatus)
+    if not (os.path.isfile(path) and hash == gethash(path)):
+        # Userscripts are made world writable below, so they get a copy of
+        # their own rather than sharing an inode with the cache.
+        link = type != 'userscript'
+        if restorefromcache(path, hash, opts.cache_path, link):
+            iaslog('Restored %s from the download cache' % name)
+            item.setdefault('timing', {})['source'] = 'cache'
+            received = hash
+        else:
+            received = downloaditem(item, stage, opts, depnotifystatus)
+            storeincache(path, hash, opts.cache_path, opts.cache_size,
+                         link)
         # Time to install.
         iaslog('Hash validated - received: %s expected: %s' % (
-               gethash(path), hash))
+               received, hash))
+        marktime(item, 'verified')
         # Fix script permissions.
         if os.path.splitext(path)[1] != ".pkg":
             os.chmod(path, 0755)
@@ -310,6 +1130,314 @@ def download_if_needed(item, stage, type, opts, depnotifystatus):
             os.chmod(path, 0777)
 
 
+def proxyurl(cacheproxy, url, hash):
+    '''Returns the URL to request url through the cache proxy with'''
+    return '%s/?%s' % (cacheproxy.rstrip('/'), urllib.urlencode(
+        [('url', url), ('hash', hash)]))
+
+
+def needsdownload(item):
+    '''Returns True if the main loop is going to download this item'''
+    try:
+        type = item['type']
+        if type == 'package':
+            try:
+                pkg_required = item['required']
+            except KeyError:
+                pkg_required = False
+            return pkg_required or LooseVersion(checkreceipt(
+                item['packageid'])) < LooseVersion(item['version'])
+        elif type in ('rootscript', 'userscript'):
+            return 'url' in item
+    except KeyError:
+        pass
+    return False
+
+
+class Prefetcher(object):
+    '''Downloads the upcoming items of a stage in a background thread while
+    the current item installs. The main loop still installs and runs items
+    strictly in manifest order, and the prefetcher never runs more than
+    depth items ahead of it.'''
+
+    def __init__(self, items, depth, stage, opts):
+        self.items = items
+        self.depth = depth
+        self.stage = stage
+        self.opts = opts
+        self.current = -1
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.depth > 0 and len(self.items) > 1:
+            self.thread.start()
+
+    def run(self):
+        for index, item in enumerate(self.items):
+            with self.cond:
+                while index > self.current + self.depth:
+                    self.cond.wait()
+                if index <= self.current:
+                    # The main loop already got here, leave it alone.
+                    continue
+                if not needsdownload(item):
+                    continue
+                self.pending.add(index)
+            try:
+                iaslog('Prefetching %s' % item['name'])
+                # DEPNotify only hears about the item being installed, so
+                # its status and progress bar stay in step with it. The
+                # download step is sent once the main loop gets here.
+                download_if_needed(item, self.stage, item['type'], self.opts,
+                                   False)
+                item['prefetched'] = True
+            except (Exception, SystemExit) as err:
+                # The main loop will retry the download and handle the
+                # failure itself.
+                iaslog('Prefetch failed for %s: %s' % (
+                       item.get('name'), str(err)))
+            with self.cond:
+                self.pending.discard(index)
+                self.cond.notify_all()
+
+    def wait(self, index):
+        '''Marks item index as the one being processed and blocks until any
+        prefetch of it has finished.'''
+        with self.cond:
+            self.current = index
+            self.cond.notify_all()
+            while index in self.pending:
+                self.cond.wait()
+
+
+def loadbootstrap(jsonpath):
+    '''Returns the parsed bootstrap.json at jsonpath, or None if it is
+    missing or not valid json.'''
+    try:
+        with open(jsonpath) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def processitem(item, stage, opts, depnotifystatus, userscripttouchpath):
+    '''Downloads and installs or runs a single item. Returns True if it
+    succeeded.'''
+    marktime(item, 'started')
+    try:
+        return handleitem(item, stage, opts, depnotifystatus,
+                          userscripttouchpath)
+    finally:
+        marktime(item, 'done')
+
+
+def handleitem(item, stage, opts, depnotifystatus, userscripttouchpath):
+    # Set the filepath, name and type.
+    try:
+        path = item['file']
+        name = item['name']
+        type = item['type']
+    except KeyError as e:
+        iaslog('Invalid item %s: %s' % (repr(item), str(e)))
+        return False
+    iaslog('%s processing %s %s at %s' % (stage, type, name, path))
+
+    if type == 'package':
+        packageid = item['packageid']
+        version = item['version']
+        try:
+            pkg_required = item['required']
+        except KeyError:
+            pkg_required = False
+        # Compare version of package with installed version and ensure
+        # pkg is not a required install
+        if LooseVersion(checkreceipt(packageid)) >= LooseVersion(
+                version) and not pkg_required:
+            iaslog('Skipping %s - already installed.' % (name))
+            return True
+        # Download the package if it isn't already on disk.
+        download_if_needed(item, stage, type, opts, depnotifystatus)
+
+        # On userland stage, we want to wait until we are actually
+        # in the user's session.
+        if stage == 'userland':
+            waitforusersession('Detected SetupAssistant in userland '
+                               'stage - delaying install until user '
+                               'session.')
+        iaslog('Installing %s from %s' % (name, path))
+        progress = None
+        if opts.depnotify:
+            if stage == 'setupassistant':
+                iaslog(
+                    'Skipping DEPNotify notification due to '
+                    'setupassistant.')
+            else:
+                if depnotifystatus:
+                    depstatus('Installing: %s' % (name), 0)
+                    progress = InstallProgress(name)
+        # Install the package
+        marktime(item, 'install_start')
+        installerstatus = installpackage(item['file'],
+                                         progress and progress.update)
+        if progress:
+            progress.finish()
+        if installerstatus == 0:
+            recordreceipt(packageid, version)
+        return installerstatus == 0
+    elif type == 'rootscript':
+        if 'url' in item:
+            download_if_needed(item, stage, type, opts, depnotifystatus)
+        iaslog('Starting root script: %s' % (path))
+        try:
+            donotwait = item['donotwait']
+        except KeyError as e:
+            donotwait = False
+        # The preflight result decides whether the run continues, so
+        # preflight scripts always run in the foreground.
+        try:
+            parallel = item['parallel'] and stage != 'preflight'
+        except KeyError as e:
+            parallel = False
+        if opts.depnotify:
+            if depnotifystatus:
+                depstatus('Installing: %s' % (name))
+        marktime(item, 'install_start')
+        return runrootscript(path, donotwait, parallel)
+    elif type == 'userscript':
+        if stage == 'setupassistant':
+            iaslog('Detected setupassistant and user script. '
+                   'User scripts cannot work in setupassistant stage! '
+                   'Removing %s' % path)
+            os.remove(path)
+            pass
+        if 'url' in item:
+            download_if_needed(item, stage, type, opts, depnotifystatus)
+        # The LaunchAgent runs one user script at a time.
+        with g_userscript_lock:
+            iaslog('Triggering LaunchAgent for user script: %s' % (path))
+            if opts.depnotify:
+                if depnotifystatus:
+                    depstatus('Installing: %s' % (name))
+            marktime(item, 'install_start')
+            triggeruserscript(path, userscripttouchpath)
+        return True
+    return False
+
+
+def runscheduleditem(item, stage, opts, depnotifystatus, userscripttouchpath):
+    '''Runs item for ItemScheduler. A parallel root script is waited for
+    before the item counts as done, so the items that depend on it don't
+    start while it is still running.'''
+    result = processitem(item, stage, opts, depnotifystatus,
+                         userscripttouchpath)
+    if item.get('type') == 'rootscript' and item.get('parallel'):
+        result = not waitforparallelscripts([item['file']]) and result
+    return result
+
+
+def usesdependencies(items):
+    '''Returns True if any item in a stage declares depends_on'''
+    return any('depends_on' in item for item in items)
+
+
+class ItemScheduler(object):
+    '''Runs the items of a stage on up to workers threads, starting each item
+    as soon as the items it depends on are done.
+
+    Items are identified by their id, or by their name if they have no id.
+    depends_on lists the ids an item has to wait for, and an empty list means
+    it can start right away. Items without depends_on wait for the item before
+    them, just like they would in a sequential run.'''
+
+    def __init__(self, items, workers, runitem):
+        self.items = items
+        self.workers = max(1, workers)
+        self.runitem = runitem
+        self.cond = threading.Condition()
+        self.error = None
+        self.running = 0
+        self.done = set()
+        self.remaining = set(range(len(items)))
+        ids = {}
+        for index, item in enumerate(items):
+            ids.setdefault(item.get('id', item.get('name')), []).append(index)
+        self.dependencies = {}
+        for index, item in enumerate(items):
+            if 'depends_on' in item:
+                depends_on = item['depends_on']
+                if not isinstance(depends_on, list):
+                    depends_on = [depends_on]
+                deps = set()
+                for dependency in depends_on:
+                    if dependency not in ids:
+                        iaslog('%s depends on unknown item %s: ignoring' % (
+                               item.get('name'), dependency))
+                    deps.update(x for x in ids.get(dependency, [])
+                                if x != index)
+            elif index > 0:
+                deps = set([index - 1])
+            else:
+                deps = set()
+            self.dependencies[index] = deps
+
+    def ready(self):
+        '''Returns the first item in manifest order whose dependencies are
+        done, or None'''
+        for index in sorted(self.remaining):
+            if self.dependencies[index] <= self.done:
+                return index
+        return None
+
+    def run(self):
+        '''Runs all items and returns once they are done. Re-raises the first
+        exception (including SystemExit) raised by an item.'''
+        threads = []
+        for x in range(min(self.workers, len(self.items))):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join() without a timeout can't be interrupted in Python 2
+            while thread.is_alive():
+                thread.join(1)
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.error or not self.remaining:
+                        return
+                    index = self.ready()
+                    if index is not None:
+                        break
+                    if not self.running:
+                        iaslog('Circular depends_on in items: %s' % ', '.join(
+                               str(self.items[x].get('name'))
+                               for x in sorted(self.remaining)))
+                        self.error = (SystemExit, SystemExit(1), None)
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait()
+                self.remaining.discard(index)
+                self.running += 1
+            try:
+                self.runitem(self.items[index])
+            except (Exception, SystemExit):
+                with self.cond:
+                    if not self.error:
+                        self.error = sys.exc_info()
+            with self.cond:
+                self.running -= 1
+                self.done.add(index)
+                self.cond.notify_all()
+
+
 def touch(path):
     try:
         touchfile = ['/usr/bin/touch', path]
@@ -322,6 +1450,27 @@ def touch(path):
         return None
 
 
+def writetouchfile(path, contents):
+    '''Creates the touch file at path holding contents, readable and
+    removable by the user. It is created afresh so a file or link someone
+    else left at path isn't written through.'''
+    try:
+        if os.path.lexists(path):
+            os.remove(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            if isinstance(contents, unicode):
+                contents = contents.encode('UTF-8')
+            os.write(fd, contents)
+            os.fchmod(fd, 0777)
+        finally:
+            os.close(fd)
+        return True
+    except OSError as err:
+        iaslog('Could not create %s: %s' % (path, str(err)))
+        return False
+
+
 def cleanup(iapath, ialdpath, ldidentifier, ialapath, laidentifier, userid,
             reboot):
     # Attempt to remove the LaunchDaemon
@@ -353,6 +1502,8 @@ def cleanup(iapath, ialdpath, ldidentifier, ialapath, laidentifier, userid,
 
     if not reboot:
         iaslog('Attempting to remove LaunchDaemon: ' + ldidentifier)
+        # Removing the LaunchDaemon kills us, so write out the log first.
+        flushlogs()
         launchctl('/bin/launchctl', 'remove', ldidentifier)
         iaslog('Cleanup done. Exiting.')
         sys.exit(0)
@@ -388,9 +1539,58 @@ def main():
     o.add_option('--userscript', default=None,
                  help=('Optional: Trigger a user script run.'),
                  action='store_true')
+    o.add_option('--download-retries', default=3, type='int',
+                 help=('Optional: Number of times to retry a failed '
+                       'download.'))
+    o.add_option('--retry-backoff', default=1.0, type='float',
+                 help=('Optional: Base number of seconds to wait before '
+                       'retrying a download. Doubles on every retry.'))
+    o.add_option('--cache-path', default=None,
+                 help=('Optional: Keep downloads in a cache at this path, '
+                       'keyed by their sha256 hash, so later runs and items '
+                       'with the same hash don\'t download them again.'))
+    o.add_option('--cache-proxy', default=None,
+                 help=('Optional: URL of a cacheproxy.py server to download '
+                       'items through.'))
+    o.add_option('--cache-size', default=10240, type='int',
+                 help=('Optional: Maximum size of the download cache in '
+                       'megabytes.'))
+    o.add_option('--download-segments', default=1, type='int',
+                 help=('Optional: Download large files as this many byte '
+                       'ranges at once.'))
+    o.add_option('--workers', default=4, type='int',
+                 help=('Optional: Number of items to process at once in '
+                       'stages that use depends_on.'))
+    o.add_option('--log', default=[], action='append', dest='logs',
+                 help=('Optional: Where to log: nslog, stderr, file:<path> '
+                       'or jsonl:<path>. Can be passed multiple times. '
+                       'Defaults to nslog.'))
+    o.add_option('--report-path',
+                 default=('/private/var/tmp/installapplications/'
+                          'installapplications.report.json'),
+                 help=('Optional: Where to write a JSON report of how long '
+                       'each item took. Must be outside the '
+                       'InstallApplications directory.'))
+    o.add_option('--transport', default=None,
+                 choices=sorted(gurl.TRANSPORTS.keys()),
+                 help=('Optional: How to download: foundation '
+                       '(NSURLSession, the default) or http (httplib with '
+                       'keep-alive connections).'))
+    o.add_option('--prefetch-depth', default=0, type='int',
+                 help=('Optional: Number of upcoming items to download while '
+                       'the current item installs. 0 disables prefetching.'))
 
     opts, args = o.parse_args()
 
+    if opts.logs:
+        try:
+            g_log.configure([ialog.backend(x) for x in opts.logs])
+        except ValueError as e:
+            o.error(str(e))
+
+    if opts.transport:
+        gurl.set_transport(opts.transport)
+
     # Dry run that doesn't actually run or install anything.
     if opts.dry_run:
         global g_dry_run
@@ -411,6 +1611,7 @@ def main():
 
     # Begin logging events
     iaslog('Beginning InstallApplications run')
+    started = time.time()
 
     # installapplications variables
     iapath = opts.iapath
@@ -437,7 +1638,12 @@ def main():
 
     if opts.userscript:
         iaslog('Running in userscript mode')
-        uscript = runuserscript(iauserscriptpath)
+        # Run the scripts the daemon sends until it is done with us. If it
+        # isn't listening, run the script that is waiting in the folder.
+        if agentipc.serve(AGENT_SOCKET_PATH, runuserscriptfile):
+            iaslog('Finished running user scripts')
+            sys.exit(0)
+        uscript = runuserscript(iauserscriptpath, userscripttouchpath)
         if uscript:
             os.remove(userscripttouchpath)
             sys.exit(0)
@@ -494,7 +1700,9 @@ def main():
     json_data = {
             'url': jsonurl,
             'file': jsonpath,
-            'name': 'Bootstrap.json'
+            'name': 'Bootstrap.json',
+            'download_only_if_changed': True,
+            'accept_encoding': True
         }
 
     # Grab auth headers if they exist and update the json_data dict.
@@ -502,21 +1710,48 @@ def main():
         headers = {'Authorization': opts.headers}
         json_data.update({'additional_headers': headers})
 
-    # Delete the bootstrap file if it exists, to ensure it's up to date.
-    if not opts.skip_validation:
-        if os.path.isfile(jsonpath):
-            iaslog('Removing and redownloading bootstrap.json')
-            os.remove(jsonpath)
+    # Use the bootstrap file as-is if we were told to skip validation.
+    iajson = None
+    if opts.skip_validation:
+        iajson = loadbootstrap(jsonpath)
 
-    # If the file doesn't exist, grab it and wait half a second to save.
-    while not os.path.isfile(jsonpath):
+    # Otherwise revalidate it with the server. gurl sends the ETag and
+    # Last-Modified values stored with our copy and leaves the file alone if
+    # the server answers 304 Not Modified. Wait half a second before trying
+    # again if the download failed.
+    while iajson is None:
         iaslog('Starting download: %s' % (urllib.unquote(
             json_data['url']).decode('utf8')))
-        downloadfile(json_data)
-        time.sleep(0.5)
-
-    # Load up file to grab all the items.
-    iajson = json.loads(open(jsonpath).read())
+        connection = downloadfile(json_data)
+        if connection.error is None and connection.status == 304:
+            iaslog('bootstrap.json is unchanged on the server')
+        if connection.error is None and (
+                connection.status in (None, 304)
+                or str(connection.status).startswith('2')):
+            # Load up file to grab all the items.
+            iajson = loadbootstrap(jsonpath)
+            if iajson is None and os.path.isfile(jsonpath):
+                iaslog('Removing invalid bootstrap.json')
+                os.remove(jsonpath)
+        if iajson is None:
+            time.sleep(0.5)
+
+    # Snapshot the installed package receipts once for the whole run.
+    loadreceipts()
+
+    # Send item downloads through a site-local cache proxy if we have one.
+    cacheproxy = opts.cache_proxy or iajson.get('cache_proxy')
+    if cacheproxy:
+        iaslog('Using cache proxy: %s' % cacheproxy)
+        for stage in ['preflight', 'setupassistant', 'userland']:
+            for item in iajson.get(stage, []):
+                # The proxy checks the hash of what it fetches, which for
+                # a compressed file isn't the hash in the manifest.
+                if ('url' in item and 'hash' in item
+                        and not item.get('compression')):
+                    item['origin_url'] = item['url']
+                    item['url'] = proxyurl(cacheproxy, item['url'],
+                                           item['hash'])
 
     # Set the stages
     stages = ['preflight', 'setupassistant', 'userland']
@@ -533,13 +1768,18 @@ def main():
                     numberofitems += int(len(iajson[stage]))
                 except KeyError:
                     iaslog('Malformed JSON - missing %s stage key' % stage)
-        # Mulitply by two for download and installation status messages
+        # Mulitply by two for download and installation status messages.
+        # The bar is moved manually so that package installs can fill in
+        # their share as installer reports progress.
         if depnotifystatus:
-            deplog('Command: Determinate: %d' % (numberofitems*2))
+            deplog('Command: DeterminateManual: %d' % (
+                numberofitems * 2 * DEPNOTIFY_STEPS))
 
     # Process all stages
     for stage in stages:
         iaslog('Beginning %s' % (stage))
+        for item in iajson.get(stage, []):
+            marktime(item, 'queued')
         if stage == 'preflight':
             # Ensure we actually have a preflight key in the json
             try:
@@ -560,12 +1800,9 @@ def main():
                     if 'DEPNotifyArguments:' in depnstr:
                         depnotifyarguments = depnstr.split(' ', 1)[-1]
             if depnotifypath:
-                while (getconsoleuser()[0] is None
-                       or getconsoleuser()[0] == u'loginwindow'
-                       or getconsoleuser()[0] == u'_mbsetupuser'):
-                    iaslog('Detected SetupAssistant in userland stage - '
-                           'delaying DEPNotify launch until user session.')
-                    time.sleep(1)
+                waitforusersession('Detected SetupAssistant in userland '
+                                   'stage - delaying DEPNotify launch until '
+                                   'user session.')
                 iaslog('Creating DEPNotify Launcher')
                 depnotifyscriptpath = os.path.join(
                     iauserscriptpath,
@@ -605,105 +1842,45 @@ def main():
                 with open(depnotifyscriptpath, 'wb') as f:
                     f.write(depnotifyscript)
                 os.chmod(depnotifyscriptpath, 0777)
-                touch(userscripttouchpath)
-                while os.path.isfile(userscripttouchpath):
-                    iaslog('Waiting for DEPNotify script to complete')
-                    time.sleep(0.5)
+                iaslog('Waiting for DEPNotify script to complete')
+                triggeruserscript(depnotifyscriptpath, userscripttouchpath)
+        if stage != 'preflight' and usesdependencies(iajson[stage]):
+            # Run independent items concurrently.
+            iaslog('Scheduling %s items by dependency with %d workers' % (
+                   stage, opts.workers))
+            scheduler = ItemScheduler(
+                iajson[stage], opts.workers,
+                lambda item: runscheduleditem(item, stage, opts,
+                                              depnotifystatus,
+                                              userscripttouchpath))
+            scheduler.run()
+            waitforparallelscripts()
+            continue
+        # Download upcoming items in the background while we install.
+        prefetcher = Prefetcher(iajson[stage], opts.prefetch_depth, stage,
+                                opts)
+        if stage != 'preflight':
+            prefetcher.start()
         # Loop through the items and download/install/run them.
-        for item in iajson[stage]:
-            # Set the filepath, name and type.
-            try:
-                path = item['file']
-                name = item['name']
-                type = item['type']
-            except KeyError as e:
-                iaslog('Invalid item %s: %s' % (repr(item), str(e)))
-                continue
-            iaslog('%s processing %s %s at %s' % (stage, type, name, path))
-
-            if type == 'package':
-                packageid = item['packageid']
-                version = item['version']
-                try:
-                    pkg_required = item['required']
-                except KeyError:
-                    pkg_required = False
-                # Compare version of package with installed version and ensure
-                # pkg is not a required install
-                if LooseVersion(checkreceipt(packageid)) >= LooseVersion(
-                        version) and not pkg_required:
-                    iaslog('Skipping %s - already installed.' % (name))
+        for index, item in enumerate(iajson[stage]):
+            prefetcher.wait(index)
+            result = processitem(item, stage, opts, depnotifystatus,
+                                 userscripttouchpath)
+            if stage == 'preflight' and item.get('type') == 'rootscript':
+                if result:
+                    iaslog('Preflight passed all checks. Skipping run.')
+                    writereport(opts.report_path, iajson, started)
+                    userid = str(getconsoleuser()[1])
+                    cleanup(iapath, ialdpath, ldidentifier, ialapath,
+                            laidentifier, userid, reboot)
                 else:
-                    # Download the package if it isn't already on disk.
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
-
-                    # On userland stage, we want to wait until we are actually
-                    # in the user's session.
-                    if stage == 'userland':
-                        if len(iajson['userland']) > 0:
-                            while (getconsoleuser()[0] is None
-                                   or getconsoleuser()[0] == u'loginwindow'
-                                   or getconsoleuser()[0] == u'_mbsetupuser'):
-                                iaslog('Detected SetupAssistant in userland '
-                                       'stage - delaying install until user '
-                                       'session.')
-                                time.sleep(1)
-                    iaslog('Installing %s from %s' % (name, path))
-                    if opts.depnotify:
-                        if stage == 'setupassistant':
-                            iaslog(
-                                'Skipping DEPNotify notification due to '
-                                'setupassistant.')
-                        else:
-                            if depnotifystatus:
-                                deplog('Status: Installing: %s' % (name))
-                    # Install the package
-                    installerstatus = installpackage(item['file'])
-            elif type == 'rootscript':
-                if 'url' in item:
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
-                iaslog('Starting root script: %s' % (path))
-                try:
-                    donotwait = item['donotwait']
-                except KeyError as e:
-                    donotwait = False
-                if opts.depnotify:
-                    if depnotifystatus:
-                        deplog('Status: Installing: %s' % (name))
-                if stage == 'preflight':
-                    preflightrun = runrootscript(path, donotwait)
-                    if preflightrun:
-                        iaslog('Preflight passed all checks. Skipping run.'
-                                )
-                        userid = str(getconsoleuser()[1])
-                        cleanup(iapath, ialdpath, ldidentifier, ialapath,
-                                laidentifier, userid, reboot)
-                    else:
-                        iaslog('Preflight did not pass all checks. '
-                                'Continuing run.')
-                        continue
-
-                runrootscript(path, donotwait)
-            elif type == 'userscript':
-                if stage == 'setupassistant':
-                    iaslog('Detected setupassistant and user script. '
-                           'User scripts cannot work in setupassistant stage! '
-                           'Removing %s') % path
-                    os.remove(path)
-                    pass
-                if 'url' in item:
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
-                iaslog('Triggering LaunchAgent for user script: %s' % (path))
-                touch(userscripttouchpath)
-                if opts.depnotify:
-                    if depnotifystatus:
-                        deplog('Status: Installing: %s' % (name))
-                while os.path.isfile(userscripttouchpath):
-                    iaslog('Waiting for user script to complete: %s' % (path))
-                    time.sleep(0.5)
+                    iaslog('Preflight did not pass all checks. '
+                           'Continuing run.')
+        # Parallel scripts have to finish before the next stage starts.
+        waitforparallelscripts()
+
+    # The LaunchAgent stays around for more user scripts until told to quit.
+    stopuseragent(userscripttouchpath)
 
     # Trigger the final DEPNotify events
     if opts.depnotify:
@@ -716,6 +1893,9 @@ def main():
                 iaslog(
                     'Skipping DEPNotify notification event due to completion.')
 
+    # Write the report before cleanup removes everything.
+    writereport(opts.report_path, iajson, started)
+
     # Cleanup and trigger a reboot if required.
     userid = str(getconsoleuser()[1])
     cleanup(iapath, ialdpath, ldidentifier, ialapath, laidentifier, userid,
@@ -723,6 +1903,7 @@ def main():
 
     if reboot:
         iaslog('Triggering reboot')
+        flushlogs()
         subprocess.call(['/sbin/shutdown', '-r', 'now'])
 
 